@@ -0,0 +1,75 @@
+import datetime
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+# builds a database of schema version 8 with one row per word, migrates it to the packed pages table and reports
+# both file sizes. the results are appended to bench_output.txt to track them over time.
+# usage: python benchmarks/db_size.py [pages]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "main", "python"))
+
+import api
+
+
+def random_page(rng: random.Random):
+    # 40 lines of 3 to 9 words as tesseract reports them for a receipt at 300 dpi
+    words = []
+    for line in range(40):
+        left = 100
+        top = 100 + line * 60 + rng.randint(0, 3)
+        for i in range(rng.randint(3, 9)):
+            text = "".join(rng.choice("abcdefghij0123") for _ in range(rng.randint(2, 9)))
+            width = len(text) * 22 + rng.randint(0, 5)
+            words.append((text, left, top, width, 40 + rng.randint(0, 4)))
+            left += width + 25
+    return words
+
+
+def create_schema_8(db_path, num_pages):
+    db = sqlite3.connect(db_path)
+    c = db.cursor()
+    c.execute("create table settings (key text primary key, value text, help text, type text not null, hidden integer not null)")
+    c.execute("insert into settings (key, value, help, type, hidden) values('current_schema_version', '8', 'Current Schema Version', 'int', 1)")
+    c.execute("CREATE TABLE directories ( id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE )")
+    c.execute(
+        "CREATE TABLE documents ( id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE NOT NULL, directory_id INTEGER NOT NULL, FOREIGN KEY(directory_id) REFERENCES directories(id) ON DELETE CASCADE )")
+    c.execute(
+        "CREATE TABLE images ( id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE NOT NULL, directory_id INTEGER NOT NULL, document_id INTEGER, doc_page INTEGER, phash TEXT, ink REAL, dpi INTEGER, confidence REAL, FOREIGN KEY(directory_id) REFERENCES directories(id) ON DELETE CASCADE, FOREIGN KEY(document_id) REFERENCES documents(id) )")
+    c.execute(
+        "CREATE TABLE texts ( id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, left INTEGER  NOT NULL, top INTEGER NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL, image_id INTEGER NOT NULL, FOREIGN KEY(image_id) REFERENCES images(id) ON DELETE CASCADE )")
+    c.execute("insert into directories (path) values ('/receipts')")
+    rng = random.Random(1)
+    for page in range(num_pages):
+        c.execute("insert into images (path, directory_id, dpi, confidence) values (?, 1, 300, 90)",
+                  ("/receipts/{}.png".format(page),))
+        image_id = c.lastrowid
+        c.executemany("insert into texts (text, left, top, width, height, image_id) values (?, ?, ?, ?, ?, ?)",
+                      [word + (image_id,) for word in random_page(rng)])
+    db.commit()
+    db.close()
+
+
+if __name__ == '__main__':
+    num_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    directory = tempfile.mkdtemp()
+    try:
+        db_factory = api.DbFactory(directory)
+        create_schema_8(db_factory.db_path, num_pages)
+        words_size = os.path.getsize(db_factory.db_path)
+        db_factory.create().close()
+        pages_size = os.path.getsize(db_factory.db_path)
+    finally:
+        shutil.rmtree(directory)
+    revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                              universal_newlines=True, cwd=ROOT).stdout.strip()
+    line = "{} {} db_size pages={} texts={:.1f}MB pages={:.1f}MB".format(
+        datetime.datetime.now().isoformat(timespec="seconds"), revision, num_pages, words_size / 1e6, pages_size / 1e6)
+    print(line)
+    with open(os.path.join(ROOT, "bench_output.txt"), "a") as f:
+        f.write(line + "\n")
@@ -0,0 +1,40 @@
+import datetime
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# starts the app several times with --benchmark_startup and reports the time to the first paint and until the app
+# is interactive. the results are appended to bench_output.txt to track them over time.
+# usage: python benchmarks/startup.py [runs]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "src", "main", "python", "main.py")
+
+
+def run_once():
+    launch_time = time.perf_counter()
+    output = subprocess.run([sys.executable, MAIN, "--benchmark_startup"], stdout=subprocess.PIPE,
+                            universal_newlines=True, cwd=ROOT, check=True).stdout
+    process_time = time.perf_counter() - launch_time
+    match = re.search(r"startup first_paint=([0-9.]+) interactive=([0-9.]+)", output)
+    return float(match.group(1)), float(match.group(2)), process_time
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    # the first run warms up the os file cache and is not counted
+    run_once()
+    results = [run_once() for i in range(runs)]
+    first_paint = statistics.median([result[0] for result in results])
+    interactive = statistics.median([result[1] for result in results])
+    process = statistics.median([result[2] for result in results])
+    revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                              universal_newlines=True, cwd=ROOT).stdout.strip()
+    line = "{} {} startup runs={} first_paint={:.3f}s interactive={:.3f}s process={:.3f}s".format(
+        datetime.datetime.now().isoformat(timespec="seconds"), revision, runs, first_paint, interactive, process)
+    print(line)
+    with open(os.path.join(ROOT, "bench_output.txt"), "a") as f:
+        f.write(line + "\n")
@@ -1,46 +1,596 @@
+import array
+import collections
 import hashlib
+import itertools
 import os
+import queue
 import random
+import re
 import sqlite3
 import string
+import subprocess
 import sys
 import threading
 import time
-from typing import List, Dict, Tuple
-
-import cv2
-import numpy as np
-from pdf2image import convert_from_path
-from pytesseract import pytesseract, Output
+import zlib
+from typing import List, Dict, Tuple, Callable, Iterator, TYPE_CHECKING
 
 import api_interface
+import profiling
+
+# cv2, numpy and pdf2image are imported on first use to keep the start of the app fast
+if TYPE_CHECKING:
+    import numpy as np
+
+
+IMAGE_EXTENSIONS = ["jpg", "jpeg", "png", "bmp", "pdf"]
+
+
+def find_files(path, stop=None) -> List[str]:
+    scan_files = []
+    for root, dirs, files in os.walk(path):
+        for basename in files:
+            if stop and stop():
+                return []
+            file_name, ext = os.path.splitext(basename)
+            ext = ext[1:].lower()
+            if ext not in IMAGE_EXTENSIONS:
+                continue
+            scan_files.append(os.path.join(root, basename).replace("\\", "/"))
+    return scan_files
+
+
+# approximate memory in MB of one page rendered at 300 dpi
+PAGE_MEMORY_MB = 30
+PHASH_BITS = 256
+# pixels of a page and its duplicate whose gray values (0-255) differ more count as changed
+DUPLICATE_PIXEL_DIFFERENCE = 64
+DUPLICATE_MAX_CHANGED_PIXELS = 2
+# max. number of indexed pages a page is compared with
+DUPLICATE_MAX_CANDIDATES = 3
+
+
+def prioritize_files(c: sqlite3.Cursor, files: List[str]) -> List[str]:
+    # files not indexed yet come first, small files before large ones
+    indexed = set(row[0] for row in c.execute("select path from images"))
+    indexed.update(row[0] for row in c.execute("select path from documents"))
+    sizes = {}
+    for path in files:
+        try:
+            sizes[path] = os.path.getsize(path)
+        except OSError:
+            sizes[path] = 0
+    return sorted(files, key=lambda path: (path in indexed, sizes[path]))
+
+
+def load_gray(path) -> 'np.ndarray':
+    import cv2
+    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+
+
+def page_fingerprint(gray: 'np.ndarray') -> Tuple[float, str]:
+    # returns the share of ink pixels inside the margins and a 256 bit perceptual (dct) hash of the page. like for
+    # the ocr the page is blurred and thresholded against its surrounding, so that faded print on gray paper is ink
+    # but the noise of a scan is not.
+    import cv2
+    import numpy as np
+    h, w = gray.shape
+    inner = cv2.GaussianBlur(gray[h // 20:h - h // 20, w // 20:w - w // 20], (9, 9), 0)
+    binary = cv2.adaptiveThreshold(inner, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+    ink = np.count_nonzero(binary == 0) / float(max(binary.size, 1))
+    small = cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA).astype(np.float32)
+    dct = cv2.dct(small)[:16, :16].flatten()
+    bits = dct > np.median(dct[1:])
+    phash = "%064x" % int.from_bytes(np.packbits(bits).tobytes(), "big")
+    return ink, phash
+
+
+def is_blank(fingerprint: Tuple[float, str], blank_threshold) -> bool:
+    # blank_threshold is the max. number of dark pixels per 10000 pixels
+    return blank_threshold is not None and fingerprint[0] * 10000 < blank_threshold
+
+
+def recheck_blank(ink, confidence, has_words, blank_threshold) -> bool:
+    # pages skipped as blank have neither words nor a confidence. they are indexed again if they are no longer
+    # blank with the current threshold or their ink was not measured yet.
+    if has_words or confidence is not None:
+        return False
+    return ink is None or not is_blank((ink, None), blank_threshold)
+
+
+class PageHashes:
+    # in memory index of the perceptual hashes of the indexed pages for finding near duplicates. hashes within
+    # max_distance bits of each other share at least one of max_distance + 1 chunks (pigeonhole principle), so only
+    # the hashes in the buckets of the chunks of a hash are compared.
+
+    def __init__(self, c: sqlite3.Cursor):
+        self.hashes = {}  # type: Dict[int, int]
+        # chunk boundaries and one bucket table per chunk, built for the last max_distance
+        self.bounds = []  # type: List[Tuple[int, int]]
+        self.tables = []  # type: List[Dict[int, List[int]]]
+        # pages without text, e.g. blank ones, are no candidates
+        rows = c.execute(
+            "select id, phash from images where phash is not null and exists (select 1 from pages where pages.image_id = images.id)")
+        for image_id, phash in rows:
+            self.hashes[int(phash, 16)] = image_id
+
+    def add(self, phash: str, image_id: int):
+        value = int(phash, 16)
+        if value not in self.hashes:
+            self.__add_to_tables(value)
+        self.hashes[value] = image_id
+
+    def find(self, phash: str, max_distance: int) -> List[Tuple[int, int]]:
+        # returns (distance, image id) of the indexed pages within max_distance bits, the closest first
+        value = int(phash, 16)
+        image_id = self.hashes.get(value)
+        if image_id is not None:
+            return [(0, image_id)]
+        if max_distance <= 0:
+            return []
+        num_chunks = min(max_distance + 1, PHASH_BITS)
+        if len(self.bounds) != num_chunks:
+            self.bounds = [(PHASH_BITS * i // num_chunks, PHASH_BITS * (i + 1) // num_chunks) for i in range(num_chunks)]
+            self.tables = [{} for _ in range(num_chunks)]
+            for other in self.hashes:
+                self.__add_to_tables(other)
+        candidates = set()
+        for (start, end), table in zip(self.bounds, self.tables):
+            candidates.update(table.get((value >> start) & ((1 << (end - start)) - 1), ()))
+        found = []
+        for other in candidates:
+            distance = bin(value ^ other).count("1")
+            if distance <= max_distance:
+                found.append((distance, self.hashes[other]))
+        found.sort()
+        return found
+
+    def __add_to_tables(self, value: int):
+        for (start, end), table in zip(self.bounds, self.tables):
+            table.setdefault((value >> start) & ((1 << (end - start)) - 1), []).append(value)
+
+
+def same_page(gray: 'np.ndarray', other: 'np.ndarray') -> bool:
+    # confirms a duplicate found by its hash, receipts of one form often have the same hash. the pages are compared
+    # at full resolution since another digit changes only a few pixels, the blur evens out jpeg artifacts.
+    import cv2
+    import numpy as np
+    if abs(gray.shape[0] / gray.shape[1] - other.shape[0] / other.shape[1]) > 0.01:
+        return False
+    if other.shape != gray.shape:
+        other = cv2.resize(other, (gray.shape[1], gray.shape[0]), interpolation=cv2.INTER_AREA)
+    diff = cv2.absdiff(cv2.GaussianBlur(gray, (3, 3), 0), cv2.GaussianBlur(other, (3, 3), 0))
+    return np.count_nonzero(diff > DUPLICATE_PIXEL_DIFFERENCE) <= DUPLICATE_MAX_CHANGED_PIXELS
+
+
+def encode_page(gray: 'np.ndarray') -> bytes:
+    # lossless, keeps the pages of a file for comparing the following pages with them
+    import cv2
+    return cv2.imencode(".png", gray)[1].tobytes()
+
+
+def decode_page(data: bytes) -> 'np.ndarray':
+    import cv2
+    import numpy as np
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+class Page:
+    # a page to index, either an image file or a rendered page of a pdf
+
+    def __init__(self, path, doc_path=None, page=None, fingerprint: Tuple[float, str] = None, dpi=None,
+                 image: 'np.ndarray' = None, preview=None):
+        self.path = path
+        self.doc_path = doc_path
+        self.page = page
+        self.fingerprint = fingerprint
+        self.dpi = dpi
+        # the gray page image while the page is processed, handed from the renderer to the ocr without copies
+        self.image = image
+        # the rendered pdf page which is written as preview image once the page is indexed. the words refer to its
+        # resolution, so it is written again whenever the page is processed.
+        self.preview = preview
+        self.words = None  # type: List[Tuple[str, int, int, int, int]]
+        self.confidence = None  # type: float
+        # id of the outdated image of this page which is replaced when storing it
+        self.replace_id = None  # type: int
+
+
+class FilePages:
+    # the ocred pages of the file being indexed, pages repeated in the file reuse their words
+
+    def __init__(self):
+        self.pages = {}  # type: Dict[str, List[Tuple[bytes, Page]]]
+
+    def add(self, page: Page):
+        self.pages.setdefault(page.fingerprint[1], []).append((encode_page(page.image), page))
+
+    def find(self, page: Page) -> Page:
+        for data, other in self.pages.get(page.fingerprint[1], ()):
+            if same_page(page.image, decode_page(data)):
+                return other
+        return None
+
+
+class ImageWriter:
+    # writes the page images for the preview in a background thread while the ocr continues
+
+    def __init__(self, max_pending=4):
+        self.queue = queue.Queue(max_pending)
+        self.thread = None  # type: threading.Thread
+        # the first error since the last flush
+        self.error = None  # type: BaseException
+
+    def write(self, image, path):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__run, args=())
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((image, path))
+
+    def flush(self):
+        # raises the first error of the writes since the last flush
+        self.queue.join()
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                image, path = item
+                image.save(path, 'JPEG')
+            except:
+                if self.error is None:
+                    self.error = sys.exc_info()[1]
+            finally:
+                self.queue.task_done()
+
+
+def save_image(image, path, writer: ImageWriter = None):
+    if writer:
+        writer.write(image, path)
+    else:
+        image.save(path, 'JPEG')
+
+
+def save_preview(page: Page, writer: ImageWriter = None):
+    if page.preview is not None:
+        save_image(page.preview, page.path, writer)
+        page.preview = None
+
+
+def pdf_to_images(path, app_data_path, poppler_path=None, max_memory_mb=None, dpi=300,
+                  profile: profiling.Profile = profiling.NULL_PROFILE) -> Iterator[Page]:
+    # yields every page of the pdf with its gray image and the rendered page for the preview
+    import numpy as np
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    kwargs = {"poppler_path": poppler_path} if poppler_path else {}
+    if max_memory_mb:
+        # render the pdf in chunks so that only a few pages are kept in memory
+        num_pages = pdfinfo_from_path(path, **kwargs)["Pages"]
+        chunk_size = max(1, int(max_memory_mb / (PAGE_MEMORY_MB * (dpi / 300.0) ** 2)))
+        chunks = [(first_page, min(first_page + chunk_size - 1, num_pages))
+                  for first_page in range(1, num_pages + 1, chunk_size)]
+    else:
+        chunks = [(None, None)]
+
+    page = 0
+    for first_page, last_page in chunks:
+        with profile.stage("poppler"):
+            images = convert_from_path(path, dpi, first_page=first_page, last_page=last_page, **kwargs)
+        while images:
+            image = images.pop(0)
+            page = page + 1
+            img_path = app_data_path + "/" + hashlib.md5(path.encode('utf-8')).hexdigest() + "_page" + str(page) + ".jpg"
+            with profile.stage("fingerprint"):
+                img_gray = np.asarray(image.convert("L"))
+                fingerprint = page_fingerprint(img_gray)
+            yield Page(img_path, path, page, fingerprint, dpi, img_gray, image)
+
+
+def render_pdf_page(path, page, dpi, poppler_path=None):
+    from pdf2image import convert_from_path
+    kwargs = {"poppler_path": poppler_path} if poppler_path else {}
+    return convert_from_path(path, dpi, first_page=page, last_page=page, **kwargs)[0]
+
+
+_tesseract_exe = None
+
+
+def set_tesseract_exe(tesseract_exe):
+    global _tesseract_exe
+    _tesseract_exe = tesseract_exe
+
+
+def run_tesseract(img: 'np.ndarray') -> List[List[str]]:
+    # passes the 8 bit gray image as uncompressed pgm through stdin and reads the tsv rows from stdout, so neither
+    # an encoded image nor a temporary file is written
+    header = "P5\n{} {}\n255\n".format(img.shape[1], img.shape[0]).encode("ascii")
+    kwargs = {"creationflags": 0x08000000} if os.name == "nt" else {}  # CREATE_NO_WINDOW
+    process = subprocess.run([_tesseract_exe or "tesseract", "stdin", "stdout", "tsv"], input=header + img.tobytes(),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, **kwargs)
+    return [line.split("\t") for line in process.stdout.decode("utf-8", "replace").splitlines()[1:]]
+
+
+def ocr_image(path, img_gray: 'np.ndarray' = None,
+              profile: profiling.Profile = profiling.NULL_PROFILE) -> Tuple[List[Tuple[str, int, int, int, int]], float]:
+    # returns (text, left, top, width, height) for every recognized word and the mean word confidence (0-100)
+    import cv2
+    with profile.stage("cv2"):
+        if img_gray is None:
+            img_gray = load_gray(path)
+        blur = cv2.GaussianBlur(img_gray, (9, 9), 0)
+        img = cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+
+    with profile.stage("tesseract"):
+        rows = run_tesseract(img)
+    words = []
+    confidences = []
+    # columns: level, page_num, block_num, par_num, line_num, word_num, left, top, width, height, conf, text
+    for row in rows:
+        if len(row) < 12 or not row[11].strip():
+            continue
+        words.append((row[11], int(row[6]), int(row[7]), int(row[8]), int(row[9])))
+        confidences.append(max(float(row[10]), 0.0))
+    confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    return words, confidence
+
+
+def ocr_page(page: Page, min_confidence=None, high_dpi=None, poppler_path=None,
+             profile: profiling.Profile = profiling.NULL_PROFILE):
+    # runs the ocr on the page. pdf pages rendered below high_dpi whose mean word confidence is below min_confidence
+    # are rendered again with high_dpi and the better result is kept along with its preview.
+    page.words, page.confidence = ocr_image(page.path, page.image, profile)
+    if min_confidence and high_dpi and page.doc_path and page.dpi and page.dpi < high_dpi \
+            and page.confidence < min_confidence:
+        import numpy as np
+        with profile.stage("poppler"):
+            image = render_pdf_page(page.doc_path, page.page, high_dpi, poppler_path)
+        words, confidence = ocr_image(page.path, np.asarray(image.convert("L")), profile)
+        if confidence > page.confidence:
+            page.preview = image
+            page.words, page.confidence, page.dpi = words, confidence, high_dpi
+
+
+def scale_words(words: List[Tuple[str, int, int, int, int]], factor) -> List[Tuple[str, int, int, int, int]]:
+    if factor == 1:
+        return words
+    return [(text, int(left * factor), int(top * factor), int(width * factor), int(height * factor))
+            for text, left, top, width, height in words]
+
+
+def reuse_words(page: Page, words: List[Tuple[str, int, int, int, int]], dpi, confidence):
+    # takes over the words of a duplicate page, scaled to the resolution of this page
+    if page.dpi and dpi and page.dpi != dpi:
+        words = scale_words(words, page.dpi / float(dpi))
+    page.words = words
+    page.confidence = confidence
+
+
+def set_thread_nice(nice):
+    # lowers the priority of the calling thread, tesseract and poppler inherit it. on linux the io priority follows
+    # the cpu priority as long as no explicit io priority is set. only linux has priorities per thread, elsewhere
+    # the native id of a thread is no process id and the priority is left alone.
+    if not nice or not sys.platform.startswith("linux"):
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+    except OSError:
+        pass
+
+
+def get_directory_id(c: sqlite3.Cursor, path) -> int:
+    res = c.execute("select id from directories where path = ?", (path,)).fetchone()
+    if res is not None:
+        return res[0]
+    c.execute("insert into 'directories' (path) values (?)", (path,))
+    return c.lastrowid
+
+
+def pack_words(words: List[Tuple[str, int, int, int, int]]) -> Tuple[str, bytes]:
+    # returns the text of a page with one word per line and the packed boxes of the words. the lefts, tops, widths
+    # and heights are stored one column after the other as differences to the previous value, which are mostly small
+    # or zero for the words of a line, as int16 if possible and compressed.
+    text = "\n".join(word[0].replace("\n", " ") for word in words)
+    values = [word[column] for column in range(1, 5) for word in words]
+    deltas = [value - previous for value, previous in zip(values, [0] + values[:-1])]
+    typecode = "h" if all(-32768 <= delta < 32768 for delta in deltas) else "i"
+    boxes = array.array(typecode, deltas)
+    if sys.byteorder == "big":
+        boxes.byteswap()
+    return text, typecode.encode("ascii") + zlib.compress(boxes.tobytes())
+
+
+class PackedWords:
+    # the words of a page as stored in the pages table, the boxes are decoded on first access
+
+    def __init__(self, text: str, blob: bytes):
+        self.text = text
+        self.blob = blob
+        self.boxes = None  # type: List[int]
+
+    def get_texts(self) -> List[str]:
+        return self.text.split("\n") if self.text else []
+
+    def get_box(self, index) -> Tuple[int, int, int, int]:
+        # returns left, top, width, height of the word
+        if self.boxes is None:
+            deltas = array.array(self.blob[:1].decode("ascii"))
+            deltas.frombytes(zlib.decompress(self.blob[1:]))
+            if sys.byteorder == "big":
+                deltas.byteswap()
+            self.boxes = list(itertools.accumulate(deltas))
+        n = len(self.boxes) // 4
+        return self.boxes[index], self.boxes[n + index], self.boxes[2 * n + index], self.boxes[3 * n + index]
+
+    def unpack(self) -> List[Tuple[str, int, int, int, int]]:
+        return [(text,) + self.get_box(i) for i, text in enumerate(self.get_texts())]
+
+
+_LIKE_FOLD = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def like_fold(text: str) -> str:
+    # sqlite's like only ignores the case of ascii characters
+    return text.translate(_LIKE_FOLD)
+
+
+def like_matcher(pattern: str) -> Callable[[str], bool]:
+    # matches a single word like sqlite's like operator
+    regex = "".join(".*" if ch == "%" else "." if ch == "_" else re.escape(ch) for ch in like_fold(pattern))
+    compiled = re.compile(regex, re.DOTALL)
+    return lambda text: compiled.fullmatch(like_fold(text)) is not None
+
+
+def get_words(c: sqlite3.Cursor, image_id) -> Tuple[List[Tuple[str, int, int, int, int]], int, float]:
+    # returns the words, the dpi and the confidence of an indexed image
+    row = c.execute("select text, words from pages where image_id = ?", (image_id,)).fetchone()
+    words = PackedWords(row[0], row[1]).unpack() if row else []
+    dpi, confidence = c.execute("select dpi, confidence from images where id = ?", (image_id,)).fetchone()
+    return words, dpi, confidence
+
+
+def store_page(c: sqlite3.Cursor, dir_id, page: Page) -> int:
+    if page.replace_id is not None:
+        # the page has changed since it was indexed
+        c.execute("delete from images where id = ?", (page.replace_id,))
+    ink, phash = page.fingerprint if page.fingerprint else (None, None)
+    c.execute("insert into 'images' (path, directory_id, phash, ink, dpi, confidence) values (?, ?, ?, ?, ?, ?)",
+              (page.path, dir_id, phash, ink, page.dpi, page.confidence))
+    image_id = c.lastrowid
+    if page.words:
+        c.execute("insert into pages (image_id, text, words) values (?, ?, ?)",
+                  (image_id,) + pack_words(page.words))
+
+    if page.doc_path and page.page:
+        doc_id = c.execute("select id from documents where path = ?", (page.doc_path,)).fetchone()
+        if doc_id is None:
+            c.execute("insert into documents (path, directory_id) values (?, ?)", (page.doc_path, dir_id))
+            doc_id = c.lastrowid
+        else:
+            doc_id = doc_id[0]
+        c.execute("update images set document_id = ?, doc_page = ? where id = ?", (doc_id, page.page, image_id))
+    return image_id
+
+
+IndexEvent = api_interface.IndexEvent
+
+
+class EventChannel:
+    # the events of an index job on a bounded ring buffer. a progress event replaces the previous one if that was
+    # not consumed yet, otherwise the oldest events are dropped when the buffer is full. listeners get every event.
+    # the progress of the job is kept here so that it is read consistently from other threads.
+    COALESCED = (IndexEvent.FILE_STARTED, IndexEvent.PAGE_DONE, IndexEvent.FILE_DONE)
+
+    def __init__(self, root: str = None, size=1000):
+        # the indexed directory, set on the published events
+        self.root = root
+        self.condition = threading.Condition()
+        self.buffer = collections.deque(maxlen=size)
+        self.listeners = []  # type: List[Callable[[IndexEvent], None]]
+        self.current = None  # type: int
+        self.total = None  # type: int
+        self.finished = False
+
+    def reset(self):
+        with self.condition:
+            self.buffer.clear()
+            self.current = None
+            self.total = None
+            self.finished = False
+
+    def publish(self, event: IndexEvent):
+        if event.root is None:
+            event.root = self.root
+        with self.condition:
+            if event.current is not None:
+                self.current = event.current
+            if event.total is not None:
+                self.total = event.total
+            if event.kind == IndexEvent.FINISHED:
+                self.finished = True
+            if self.buffer and event.kind in EventChannel.COALESCED and self.buffer[-1].kind in EventChannel.COALESCED:
+                self.buffer[-1] = event
+            else:
+                self.buffer.append(event)
+            self.condition.notify_all()
+        for listener in list(self.listeners):
+            listener(event)
+
+    def add_listener(self, listener: Callable[[IndexEvent], None]):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[IndexEvent], None]):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def get_progress(self) -> Tuple[int, int, bool]:
+        with self.condition:
+            return self.current, self.total, self.finished
+
+    def drain(self) -> List[IndexEvent]:
+        with self.condition:
+            events = list(self.buffer)
+            self.buffer.clear()
+        return events
+
+    def iterate(self, timeout: float = None) -> Iterator[IndexEvent]:
+        # ends with the finished event, or right away if that was drained already
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.buffer or self.finished, timeout)
+                if not self.buffer:
+                    return
+                event = self.buffer.popleft()
+            yield event
+            if event.kind == IndexEvent.FINISHED:
+                return
 
 
 class IndexJob(api_interface.IndexJob):
 
-    def __init__(self, path, db_factory: api_interface.DbFactory, app_data_path, poppler_path=None, tesseract_exe=None):
+    def __init__(self, path, db_factory: api_interface.DbFactory, app_data_path, poppler_path=None, tesseract_exe=None,
+                 blank_threshold=None, duplicate_distance=None):
         self.path = path
         self.db_factory = db_factory
         self.app_data_path = app_data_path
         self.poppler_path = poppler_path
         self.tesseract_exe = tesseract_exe
+        self.blank_threshold = blank_threshold
+        self.duplicate_distance = duplicate_distance
+        self.dpi = 300
+        # pdfs are rendered with low_dpi first if set, pages with a lower confidence again with dpi
+        self.low_dpi = None
+        self.min_confidence = None
+        self.page_hashes = None  # type: PageHashes
+        self.writer = None  # type: ImageWriter
 
         self._stop = False
-        self.curr_file_idx = None
-        self.num_files = None
         self.status = None  # type: str
-        self.finished = False
+        self.events = EventChannel(path)
 
-        self.__messages_mutex = threading.Lock()
-        self.__messages = None  # type: List[str]
+        self.nice = None  # type: int
+        self.max_memory_mb = None  # type: int
+        self.throttle = None  # type: Callable[[], None]
+
+        self.profiler = None  # type: profiling.Profiler
+        # the profile of the current run
+        self.profile = profiling.NULL_PROFILE  # type: profiling.Profile
 
     def start(self):
         # init vars
         self._stop = False
-        self.curr_file_idx = None
-        self.num_files = None
-        self.__messages = []  # type: List[str]
-        self.finished = False
+        self.events.reset()
         # start thread
         thread = threading.Thread(target=self.run, args=())
         thread.daemon = True  # Daemonize thread
@@ -53,164 +603,216 @@ class IndexJob(api_interface.IndexJob):
         return self.path
 
     def get_curr_file_index(self) -> int:
-        return self.curr_file_idx
+        return self.events.get_progress()[0]
 
-    def get_num_files(self) -> str:
-        return self.num_files
+    def get_num_files(self) -> int:
+        return self.events.get_progress()[1]
 
-    def get_messages(self) -> List[str]:
-        messages = []
-        with self.__messages_mutex:
-            for message in self.__messages:
-                messages.append(message)
-            self.__messages.clear()
-        return messages
+    def add_listener(self, listener: Callable[[IndexEvent], None]):
+        self.events.add_listener(listener)
 
-    def is_finished(self) -> bool:
-        return self.finished
+    def remove_listener(self, listener: Callable[[IndexEvent], None]):
+        self.events.remove_listener(listener)
 
-    def __add_message(self, msg):
-        with self.__messages_mutex:
-            self.__messages.append(msg)
+    def get_events(self) -> List[IndexEvent]:
+        return self.events.drain()
 
-    def __get_files(self):
-        scan_files = []
-        for root, dirs, files in os.walk(self.path):
-            for basename in files:
-                if self._stop:
-                    return []
-                file_name, ext = os.path.splitext(basename)
-                ext = ext[1:].lower()
-                if ext not in ["jpg", "jpeg", "png", "bmp", "pdf"]:
-                    continue
-                path = os.path.join(root, basename).replace("\\", "/")
-                scan_files.append(path)
-        return scan_files
-
-    def __process_image_file(self, c: sqlite3.Cursor, path, dir_id, doc_path, page):
-
-        if c.execute("select id from images where path = ?", (path,)).fetchone() is not None:
-            self.__add_message("Skipping already indexed file {}.".format(path.replace(self.path + "/", "")))
-            return
-
-        c.execute("insert into 'images' (path, directory_id) values (?, ?)", (path, dir_id))
-        image_id = c.lastrowid
-        img = cv2.imread(path)
-        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blur = cv2.GaussianBlur(img_gray, (9, 9), 0)
-        img = cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-        # img = 255 - thresh
-        # cv2.imwrite(path.replace(self.path, "C:/Users/mueller/Desktop/output"), img)
-        # img = remove_noise.process_image_for_ocr(path)
-        if self.tesseract_exe:
-            pytesseract.pytesseract.tesseract_cmd = self.tesseract_exe
-        d = pytesseract.image_to_data(img, output_type=Output.DICT)
-
-        for j in range(len(d["text"])):
-            if not d['text'][j].strip():
-                continue
-            c.execute(
-                "insert into 'texts' (text, left, top, width, height, image_id) values (?, ?, ?, ?, ?, ?)",
-                (d['text'][j], d['left'][j], d['top'][j], d['width'][j], d['height'][j], image_id))
-
-        if doc_path and page:
-            doc_id = c.execute("select id from documents where path = ?", (doc_path,)).fetchone()
-            if doc_id is None:
-                c.execute("insert into documents (path, directory_id) values (?, ?)", (doc_path, dir_id))
-                doc_id = c.lastrowid
-            else:
-                doc_id = doc_id[0]
-            c.execute("update images set document_id = ?, doc_page = ? where id = ?", (doc_id, page, image_id))
+    def iter_events(self, timeout: float = None) -> Iterator[IndexEvent]:
+        return self.events.iterate(timeout)
+
+    def is_finished(self) -> bool:
+        return self.events.get_progress()[2]
+
+    def set_resource_limits(self, nice: int = None, max_memory_mb: int = None, throttle: Callable[[], None] = None):
+        # the scheduler passes changed limits to the running job, they apply from the next file on
+        self.nice = nice
+        self.max_memory_mb = max_memory_mb
+        self.throttle = throttle
+
+    def set_profiler(self, profiler: profiling.Profiler):
+        self.profiler = profiler
+
+    def get_settings(self) -> Dict[str, object]:
+        return {"poppler_path": self.poppler_path, "tesseract_exe": self.tesseract_exe,
+                "blank_page_threshold": self.blank_threshold, "duplicate_page_distance": self.duplicate_distance,
+                "pdf_dpi": self.dpi, "pdf_low_dpi": self.low_dpi, "min_confidence": self.min_confidence}
+
+    def set_settings(self, settings: Dict[str, object]):
+        # may be called while the job is running, the values are read again for every file or page
+        if "poppler_path" in settings:
+            self.poppler_path = settings["poppler_path"]
+        if "tesseract_exe" in settings:
+            self.tesseract_exe = settings["tesseract_exe"]
+        if "blank_page_threshold" in settings:
+            self.blank_threshold = settings["blank_page_threshold"]
+        if "duplicate_page_distance" in settings:
+            self.duplicate_distance = settings["duplicate_page_distance"]
+        if settings.get("pdf_dpi"):
+            self.dpi = settings["pdf_dpi"]
+        if "pdf_low_dpi" in settings:
+            self.low_dpi = settings["pdf_low_dpi"]
+        if "min_confidence" in settings:
+            self.min_confidence = settings["min_confidence"]
+
+    def __same_page(self, c: sqlite3.Cursor, page: Page, image_id) -> bool:
+        # compares the page with the image of an indexed page with a similar hash
+        path = c.execute("select path from images where id = ?", (image_id,)).fetchone()[0]
+        if not os.path.exists(path):
+            return False
+        return same_page(page.image, load_gray(path))
+
+    def __process_page(self, c: sqlite3.Cursor, page: Page, file_pages: FilePages) -> bool:
+        # fills in the words of the page, returns False if the page can be skipped
+        with self.profile.stage("sqlite"):
+            existing = c.execute(
+                "select id, phash, ink, confidence, exists (select 1 from pages where pages.image_id = images.id) from images where path = ?",
+                (page.path,)).fetchone()
+        # a page whose preview is missing is processed again, its words have to match the new preview
+        if existing is not None and os.path.exists(page.path) and \
+                (page.fingerprint is None or existing[1] is None or existing[1] == page.fingerprint[1]) and \
+                not recheck_blank(existing[2], existing[3], existing[4], self.blank_threshold):
+            self.events.publish(IndexEvent(IndexEvent.PAGE_DONE, page.path, detail=IndexEvent.UNCHANGED))
+            return False
+        page.replace_id = existing[0] if existing is not None else None
+
+        with self.profile.stage("fingerprint"):
+            if page.image is None:
+                page.image = load_gray(page.path)
+            if page.fingerprint is None:
+                page.fingerprint = page_fingerprint(page.image)
+        phash = page.fingerprint[1]
+        if is_blank(page.fingerprint, self.blank_threshold):
+            self.events.publish(IndexEvent(IndexEvent.PAGE_DONE, page.path, detail=IndexEvent.BLANK))
+            page.words = []
+            return True
+
+        find_duplicates = self.duplicate_distance is not None and self.duplicate_distance >= 0
+        if find_duplicates:
+            # every page with a matching hash is compared, equal hashes do not make equal receipts
+            with self.profile.stage("fingerprint"):
+                duplicate = file_pages.find(page)
+            if duplicate is not None:
+                reuse_words(page, duplicate.words, duplicate.dpi, duplicate.confidence)
+                self.events.publish(IndexEvent(IndexEvent.PAGE_DONE, page.path, detail=IndexEvent.DUPLICATE))
+                return True
+            candidates = [duplicate_id for distance, duplicate_id in self.page_hashes.find(phash, self.duplicate_distance)
+                          if duplicate_id != page.replace_id]
+            for duplicate_id in candidates[:DUPLICATE_MAX_CANDIDATES]:
+                with self.profile.stage("fingerprint"):
+                    if not self.__same_page(c, page, duplicate_id):
+                        continue
+                with self.profile.stage("sqlite"):
+                    reuse_words(page, *get_words(c, duplicate_id))
+                self.events.publish(IndexEvent(IndexEvent.PAGE_DONE, page.path, detail=IndexEvent.DUPLICATE))
+                return True
+
+        low_dpi = page.dpi
+        ocr_page(page, self.min_confidence, self.dpi, self.poppler_path, self.profile)
+        self.events.publish(IndexEvent(IndexEvent.PAGE_DONE, page.path,
+                                       detail=IndexEvent.OCR if page.dpi == low_dpi else IndexEvent.OCR_HIGH_DPI))
+        if find_duplicates:
+            file_pages.add(page)
+        return True
 
     def run(self):
+        db = None
+        result = IndexEvent.FAILED
+        self.profile = self.profiler.create("index").start() if self.profiler else profiling.NULL_PROFILE
         try:
+            nice = self.nice
+            set_thread_nice(nice)
+
             # get dir id
             db = self.db_factory.create()
             c = db.cursor()
-            res = c.execute("select id from directories where path = ?", (self.path,)).fetchone()
-            if res is not None:
-                dir_id = res[0]
-            else:
-                c.execute("insert into 'directories' (path) values (?)", (self.path,))
-                dir_id = c.lastrowid
-                db.commit()
+            dir_id = get_directory_id(c, self.path)
+            db.commit()
+            if self.tesseract_exe:
+                set_tesseract_exe(self.tesseract_exe)
+            self.page_hashes = PageHashes(c)
+            self.writer = ImageWriter()
 
             # collect files
-            self.__add_message("Scanning files in {}".format(self.path))
-            scan_files = self.__get_files()
-            self.num_files = len(scan_files)
-            self.__add_message("Scanning files finished. Found {} files for indexing.".format(self.num_files))
+            self.events.publish(IndexEvent(IndexEvent.SCANNING, self.path))
+            with self.profile.stage("scan"):
+                scan_files = prioritize_files(c, find_files(self.path, lambda: self._stop))
+            num_files = len(scan_files)
+            self.events.publish(IndexEvent(IndexEvent.SCANNED, total=num_files))
 
             # process files
-            for i in range(self.num_files):
+            for i in range(num_files):
+                if self.throttle:
+                    self.throttle()
                 if self._stop:
                     break
+                # the limits may be changed while the job is running
+                if self.nice != nice:
+                    nice = self.nice
+                    set_thread_nice(nice)
 
-                self.curr_file_idx = i
                 path = scan_files[i]
-                rel_path = path.replace(self.path + "/", "")
-
-                self.__add_message(
-                    "File {} of {}: Analyzing {}.".format(i + 1, self.num_files, rel_path))
+                self.events.publish(IndexEvent(IndexEvent.FILE_STARTED, path, i, num_files))
 
                 try:
                     _, ext = os.path.splitext(path)
-                    image_paths = []
                     if ext.lower() == ".pdf":
-
-                        self.__add_message(
-                            "Converting {} to single image files.".format(rel_path))
-                        if self.poppler_path:
-                            images = convert_from_path(path, 300, poppler_path=self.poppler_path)
-                        else:
-                            images = convert_from_path(path, 300)
-                        page = 0
-                        for image in images:
-                            page = page + 1
-                            # while True:
-                            #    img_path = self.app_data_path + "/" + self.random_string() + ".png"
-                            #    if not os.path.exists(img_path):
-                            #        break
-                            img_path = self.app_data_path + "/" + hashlib.md5(
-                                path.encode('utf-8')).hexdigest() + "_page" + str(
-                                page) + ".jpg"
-                            self.__add_message(
-                                "Writing page {} of {} as image {}.".format(page, len(images), img_path))
-                            # cv2.imwrite(img_path, image)
-                            if not os.path.exists(img_path):
-                                image.save(img_path, 'JPEG')
-                            image_paths.append((img_path, path, page))
+                        dpi = self.low_dpi if self.low_dpi and self.low_dpi < self.dpi else self.dpi
+                        pages = pdf_to_images(path, self.app_data_path, self.poppler_path, self.max_memory_mb, dpi,
+                                              self.profile)
                     else:
-                        image_paths = [(path, None, None)]
-
-                    for img_path in image_paths:
-                        self.__add_message(
-                            "Extracting text from {}.".format(
-                                img_path[0].replace(self.path + "/", "")))
+                        pages = [Page(path)]
+
+                    # the ocr runs outside of a write transaction so that concurrent jobs do not block each other
+                    processed_pages = []
+                    file_pages = FilePages()
+                    for page in pages:
+                        if self.throttle:
+                            self.throttle()
+                        # the pages processed so far are stored, the rest of the file is indexed by the next run
+                        if self._stop:
+                            break
                         try:
-                            self.__process_image_file(c, img_path[0], dir_id, img_path[1], img_path[2])
+                            if self.__process_page(c, page, file_pages):
+                                save_preview(page, self.writer)
+                                processed_pages.append(page)
                         except:
-                            self.__add_message("An unknown error occured while converting {}: {}".format(
-                                img_path[0].replace(self.path + "/", ""), sys.exc_info()[0]))
-
-                    db.commit()
+                            self.events.publish(IndexEvent(IndexEvent.ERROR, page.path, detail=sys.exc_info()[0]))
+                        # release the page images
+                        page.image = None
+                        page.preview = None
+
+                    # the previews have to exist when the pages are committed
+                    with self.profile.stage("write_previews"):
+                        self.writer.flush()
+                    with self.profile.stage("sqlite"):
+                        for page in processed_pages:
+                            image_id = store_page(c, dir_id, page)
+                            if page.words:
+                                self.page_hashes.add(page.fingerprint[1], image_id)
+                        db.commit()
+                    self.db_factory.bump_generation()
                 except:
-                    self.__add_message("An unknown error occured while processing {}: {}".format(
-                        rel_path, sys.exc_info()[0]))
+                    self.events.publish(IndexEvent(IndexEvent.ERROR, path, detail=sys.exc_info()[0]))
 
             # commit or rollback
             if self._stop:
-                self.__add_message("Indexing stopped")
+                result = IndexEvent.STOPPED
                 db.rollback()
             else:
-                self.__add_message("Indexing successfully finished")
+                result = IndexEvent.DONE
                 db.commit()
-            self.finished = True
         except:
             self._stop = True
-            e = sys.exc_info()[0]
-            self.__add_message("An unknown error occured: " + str(e))
-            db.rollback()
+            self.events.publish(IndexEvent(IndexEvent.ERROR, detail=sys.exc_info()[0]))
+            if db:
+                db.rollback()
+        finally:
+            if self.writer:
+                self.writer.close()
+            profile_path = self.profile.finish()
+            if profile_path:
+                self.events.publish(IndexEvent(IndexEvent.INFO, detail="Wrote profile to " + profile_path))
+            self.events.publish(IndexEvent(IndexEvent.FINISHED, detail=result))
 
     def random_string(self, stringLength=5):
         letters = string.ascii_lowercase
@@ -219,15 +821,14 @@ class IndexJob(api_interface.IndexJob):
 
 class Result(api_interface.Result):
 
-    def __init__(self, path, text, page, doc_path, top, left, width, height):
+    def __init__(self, path, text, page, doc_path, words: PackedWords, index):
         self.path = path
         self.text = text
         self.page = page
         self.doc_path = doc_path
-        self.top = top
-        self.left = left
-        self.width = width
-        self.height = height
+        # the match is the word with this index on the page
+        self.words = words
+        self.index = index
 
     def get_path(self) -> str:
         return self.doc_path if self.doc_path is not None else self.path
@@ -238,7 +839,8 @@ class Result(api_interface.Result):
     def get_page(self) -> int:
         return self.page
 
-    def get_preview_image(self) -> np.ndarray:
+    def get_preview_image(self) -> 'np.ndarray':
+        import cv2
         preview_image = None
 
         if not os.path.exists(self.path):
@@ -246,7 +848,7 @@ class Result(api_interface.Result):
         image = cv2.imread(self.path)
         overlay = image.copy()
 
-        x, y, w, h = self.left, self.top, self.width, self.height  # Rectangle parameters
+        x, y, w, h = self.words.get_box(self.index)  # Rectangle parameters
         cv2.rectangle(overlay, (x, y), (x + w, y + h), (0, 255, 0), -1)  # A filled rectangle
 
         alpha = 0.7  # Transparency factor.
@@ -257,15 +859,142 @@ class Result(api_interface.Result):
         return preview_image
 
 
+class SettingsCache:
+    # typed in memory copy of the visible settings. loaded once, reloaded after writes.
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.settings = None  # type: Dict[str, Tuple[str, str, str]]
+        self.values = None  # type: Dict[str, object]
+        self.listeners = []  # type: List[Callable[[Dict[str, object]], None]]
+
+    @staticmethod
+    def coerce(value, type_):
+        if value is None or value == "":
+            return None
+        if type_ == "int":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+        return value
+
+    def is_loaded(self) -> bool:
+        return self.settings is not None
+
+    def load(self, c: sqlite3.Cursor) -> Dict[str, object]:
+        # returns the values which changed
+        rows = c.execute("select key, value, help, type from settings where hidden != 1").fetchall()
+        settings = {row[0]: (row[1], row[2], row[3]) for row in rows}
+        values = {key: SettingsCache.coerce(value_, type_) for key, (value_, help_, type_) in settings.items()}
+        with self.mutex:
+            old_values = self.values or {}
+            self.settings = settings
+            self.values = values
+        return {key: value for key, value in values.items() if key not in old_values or old_values[key] != value}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def get_values(self) -> Dict[str, object]:
+        with self.mutex:
+            return dict(self.values)
+
+    def get_settings(self) -> Dict[str, Tuple[str, str, str]]:
+        with self.mutex:
+            return dict(self.settings)
+
+    def add_listener(self, listener: Callable[[Dict[str, object]], None]):
+        self.listeners.append(listener)
+
+    def notify(self, changed: Dict[str, object]):
+        for listener in self.listeners:
+            listener(changed)
+
+
+class QueryCache:
+    # lru cache of search results which is cleared with every new index generation. results of a query which
+    # contains a cached query, e.g. while typing ahead, are filtered from the complete cached results.
+
+    def __init__(self, max_entries=64):
+        self.mutex = threading.Lock()
+        self.max_entries = max_entries
+        self.generation = None
+        self.entries = collections.OrderedDict()  # type: Dict[Tuple[str, bool, int], List[Result]]
+
+    def get(self, generation: int, query: str, case_sensitive: bool, limit: int) -> List[Result]:
+        with self.mutex:
+            if generation != self.generation:
+                self.generation = generation
+                self.entries.clear()
+                return None
+            key = (query, case_sensitive, limit)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return list(self.entries[key])
+
+            # % and _ are wildcards of like, such queries are not refined
+            if "%" in query or "_" in query:
+                return None
+            folded_query = like_fold(query)
+            superset = None
+            for (cached_query, cached_case_sensitive, cached_limit), results in self.entries.items():
+                complete = cached_limit is None or len(results) < cached_limit
+                if complete and cached_case_sensitive == case_sensitive and "%" not in cached_query \
+                        and "_" not in cached_query and like_fold(cached_query) in folded_query \
+                        and (superset is None or len(results) < len(superset)):
+                    superset = results
+            if superset is None:
+                return None
+            results = [result for result in superset if folded_query in like_fold(result.text)]
+            results = results[:limit] if limit else results
+        self.put(generation, query, case_sensitive, limit, results)
+        return list(results)
+
+    def put(self, generation: int, query: str, case_sensitive: bool, limit: int, results: List[Result]):
+        with self.mutex:
+            if generation != self.generation:
+                return
+            self.entries[(query, case_sensitive, limit)] = results
+            self.entries.move_to_end((query, case_sensitive, limit))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
 class WheresTheFckReceipt(api_interface.WheresTheFckReceipt):
 
     def __init__(self, app_data_dir, db_factory: api_interface.DbFactory,
-                 index_job_factory: api_interface.IndexJobFactory):
+                 index_job_factory: api_interface.IndexJobFactory, scheduler: api_interface.IndexScheduler = None,
+                 profiler: profiling.Profiler = None):
         self.app_data_dir = app_data_dir
         self.db_factory = db_factory
         self.index_job_factory = index_job_factory
+        self.scheduler = scheduler
+        self.profiler = profiler or profiling.Profiler(app_data_dir)
+        self.settings = SettingsCache()
+        self.settings.add_listener(self.settings_changed)
+        self.query_cache = QueryCache()
         self.db = None
 
+    def get_scheduler(self) -> api_interface.IndexScheduler:
+        self.assert_db()
+        return self.scheduler
+
+    def add_settings_listener(self, listener: Callable[[Dict[str, object]], None]):
+        self.settings.add_listener(listener)
+
+    def settings_changed(self, changed: Dict[str, object]):
+        if "tesseract_exe" in changed:
+            set_tesseract_exe(changed["tesseract_exe"])
+        self.profiler.set_settings(self.get_setting("profile_mode"), self.get_setting("profile_sample_percent"),
+                                   self.get_setting("profile_slow_query_ms"))
+        if self.scheduler:
+            self.scheduler.set_limits(self.get_setting("index_max_workers"), self.get_setting("index_max_memory_mb"),
+                                      self.get_setting("index_nice"), self.get_setting("index_search_pause"))
+            # running and queued jobs pick up the new values with their next file or page
+            for index_job in self.scheduler.get_jobs():
+                index_job.set_settings(changed)
+
     def get_last_directory(self) -> str:
         self.assert_db()
         c = self.db.cursor()
@@ -276,6 +1005,8 @@ class WheresTheFckReceipt(api_interface.WheresTheFckReceipt):
     def assert_db(self):
         if not self.db:
             self.db = self.db_factory.create()
+        if not self.settings.is_loaded():
+            self.settings.notify(self.settings.load(self.db.cursor()))
 
     def get_directories(self) -> List[str]:
         self.assert_db()
@@ -285,19 +1016,27 @@ class WheresTheFckReceipt(api_interface.WheresTheFckReceipt):
         return [i[0] for i in rows]
 
     def add_directory(self, directory) -> IndexJob:
-        poppler_path = self.get_setting("poppler_path")
-        tesseract_exe = self.get_setting("tesseract_exe")
-        return self.index_job_factory.create(directory, self.db_factory, self.app_data_dir, poppler_path, tesseract_exe)
+        index_job = self.index_job_factory.create(directory, self.db_factory, self.app_data_dir,
+                                                  self.get_setting("poppler_path"), self.get_setting("tesseract_exe"),
+                                                  self.get_setting("blank_page_threshold"),
+                                                  self.get_setting("duplicate_page_distance"))
+        index_job.set_settings(self.settings.get_values())
+        index_job.set_profiler(self.profiler)
+        return index_job
 
     def remove_directory(self, directory):
         self.assert_db()
         c = self.db.cursor()
+        # the preview images of pdf pages belong to the app
         own_images = c.execute(
-            "select images.path as path from images, directories where directories.id = images.directory_id and images.document_id != null")
+            "select images.path as path from images, directories where directories.id = images.directory_id and directories.path = ? and images.document_id is not null",
+            (directory,))
         for own_image in own_images.fetchall():
-            os.remove(own_image[0])
+            if os.path.exists(own_image[0]):
+                os.remove(own_image[0])
         c.execute("delete from directories where path = ?", (directory,))
         self.db.commit()
+        self.db_factory.bump_generation()
 
     def update_directory(self, directory):
         return self.add_directory(directory)
@@ -307,97 +1046,135 @@ class WheresTheFckReceipt(api_interface.WheresTheFckReceipt):
         return self.add_directory(directory)
 
     def search(self, query: str, limit: int = None, case_sensitive: bool = False) -> List[Result]:
+        if self.scheduler:
+            self.scheduler.notify_interactive()
         self.assert_db()
-        c = self.db.cursor()
-        if case_sensitive:
-            query = "%" + query + "%"
-            text_where_clause = "texts.text like ?"
-        else:
-            query = "%" + query.lower() + "%"
-            text_where_clause = "lower(texts.text) like ?"
-
-        sql = "select images.path as path, texts.text as text, images.doc_page as page, images.document_id as doc_id, texts.top as top, texts.left as left, texts.width as width, texts.height as height from images, texts where texts.image_id = images.id and texts.text like ?"
-        if limit:
-            sql = sql + " limit ?"
-            c.execute(sql, (query, limit))
-        else:
-            c.execute(sql, (query,))
-        result_list = []
-        rows = c.fetchall()
-        for row in rows:
-            doc_id = row[3]
-            doc_path = c.execute("select path from documents where id = ?", (doc_id,)).fetchone()[0] if doc_id else None
-
-            # path, text, page, doc_path, top, left, width, height
-            result_list.append(Result(row[0], row[1], row[2], doc_path, row[4], row[5], row[6], row[7]))
-        # return [i[0] for i in rows]
-        return result_list
+        limit = limit or None
+        if not case_sensitive:
+            query = query.lower()
+        # only slow searches are written
+        slow_query_ms = self.profiler.slow_query_ms
+        profile = self.profiler.create("search", slow_query_ms / 1000.0 if slow_query_ms else None).start()
+        try:
+            # read the generation before the query, a concurrent commit then invalidates the cached results
+            generation = self.db_factory.get_generation()
+            with profile.stage("cache"):
+                result_list = self.query_cache.get(generation, query, case_sensitive, limit)
+            if result_list is not None:
+                return result_list
+
+            c = self.db.cursor()
+            # find the pages containing a match, the words of a page are matched afterwards
+            sql = "select images.path as path, images.doc_page as page, documents.path as doc_path, pages.text as text, pages.words as words from pages join images on images.id = pages.image_id left join documents on documents.id = images.document_id where pages.text like ?"
+            params = ("%" + query + "%",)
+            matches = like_matcher("%" + query + "%")
+            result_list = []
+            start = time.perf_counter()
+            with profile.stage("query"):
+                for path, page, doc_path, text, blob in c.execute(sql, params):
+                    words = PackedWords(text, blob)
+                    for index, word in enumerate(words.get_texts()):
+                        if matches(word):
+                            result_list.append(Result(path, word, page, doc_path, words, index))
+                    if limit and len(result_list) >= limit:
+                        del result_list[limit:]
+                        break
+            profile.query(c, sql, params, time.perf_counter() - start)
+            self.query_cache.put(generation, query, case_sensitive, limit, result_list)
+            return list(result_list)
+        finally:
+            profile.finish()
 
     def get_setting(self, key):
-        settings = self.get_settings()
-        if key in settings.keys():
-            value_ = settings[key][0]
-            type_ = settings[key][2]
-            if type_ == "int":
-                value_ = int(value_)
-            elif value_ == "":
-                return None
-            return value_
-        return None
-
+        self.assert_db()
+        return self.settings.get(key)
 
     def get_settings(self) -> Dict[str, Tuple[str, str, str]]:
         self.assert_db()
-        c = self.db.cursor()
-        c.execute("select key, value, help, type from settings where hidden != 1")
-        rows = c.fetchall()
-        settings = {}
-        settings_value = {}
-        for row in rows:
-            settings[row[0]] = (row[1], row[2], row[3])
-            settings_value[row[0]] = row[1]
-        return settings
+        return self.settings.get_settings()
 
     def set_settings(self, settings: Dict[str, str]):
         self.assert_db()
         c = self.db.cursor()
-        existing_settings = self.get_settings().keys()
+        existing_settings = self.settings.get_settings().keys()
         for key, value in settings.items():
             if key in existing_settings:
                 c.execute("update settings set value=? where key = ?", (value, key))
             else:
                 c.execute("insert into settings (key, value) values(?, ?)", (key, value))
         self.db.commit()
+        changed = self.settings.load(c)
+        if changed:
+            self.settings.notify(changed)
+
 
 class IndexJobFactory(api_interface.IndexJobFactory):
 
-    def create(self, path, db_factory: api_interface.DbFactory, app_data_dir, poppler_path=None, tesseract_exe=None) -> IndexJob:
-        return IndexJob(path, db_factory, app_data_dir, poppler_path, tesseract_exe)
+    def create(self, path, db_factory: api_interface.DbFactory, app_data_dir, poppler_path=None, tesseract_exe=None,
+               blank_threshold=None, duplicate_distance=None) -> IndexJob:
+        return IndexJob(path, db_factory, app_data_dir, poppler_path, tesseract_exe, blank_threshold, duplicate_distance)
+
+
+DB_PAGE_SIZE = 16384
 
 
 class DbFactory(api_interface.DbFactory):
+    # databases whose schema was already checked by this process
+    checked_db_paths = set()
+    checked_db_paths_mutex = threading.Lock()
+    # index generation of every database, bumped by every commit which changes the indexed texts
+    generations = {}  # type: Dict[str, int]
+
     def __init__(self, app_data_dir: str, delete_db=False):
         self.app_data_dir = app_data_dir
         self.db_path = app_data_dir + "/db.sqlite3"
         self.delete_db = delete_db
+        # set by schema updates which free a lot of space
+        self.vacuum = False
+
+    def get_generation(self) -> int:
+        return DbFactory.generations.get(self.db_path, 0)
+
+    def bump_generation(self):
+        with DbFactory.checked_db_paths_mutex:
+            DbFactory.generations[self.db_path] = DbFactory.generations.get(self.db_path, 0) + 1
 
     def create(self) -> sqlite3.Connection:
-        if self.delete_db and os.path.exists(self.db_path):
-            os.remove(self.db_path)
-        # database
-        db_path = self.db_path
-        if not os.path.exists(os.path.dirname(db_path)):
-            os.makedirs(os.path.dirname(db_path))
-        create_database = not os.path.exists(db_path)
-
-        db = sqlite3.connect(db_path)
-        c = db.cursor()
-        c.execute("PRAGMA foreign_keys = ON")
-        if create_database:
-            c.execute("create table settings (key text primary key, value text, help text, type text not null, hidden integer not null)")
-        self.update_schema(c)
-        db.commit()
-        return db
+        with DbFactory.checked_db_paths_mutex:
+            if self.db_path in DbFactory.checked_db_paths:
+                db = sqlite3.connect(self.db_path, timeout=30)
+                db.execute("PRAGMA foreign_keys = ON")
+                return db
+
+            if self.delete_db and os.path.exists(self.db_path):
+                os.remove(self.db_path)
+            # database
+            db_path = self.db_path
+            if not os.path.exists(os.path.dirname(db_path)):
+                os.makedirs(os.path.dirname(db_path))
+            create_database = not os.path.exists(db_path)
+
+            db = sqlite3.connect(db_path, timeout=30)
+            c = db.cursor()
+            c.execute("PRAGMA foreign_keys = ON")
+            if create_database:
+                # the packed pages of a page mostly fit into one database page
+                c.execute("PRAGMA page_size = {}".format(DB_PAGE_SIZE))
+            # lets searches read while index jobs write
+            c.execute("PRAGMA journal_mode = WAL")
+            if create_database:
+                c.execute("create table settings (key text primary key, value text, help text, type text not null, hidden integer not null)")
+            self.update_schema(c)
+            db.commit()
+            if self.vacuum:
+                # the page size can only be changed outside of the wal mode
+                db.execute("PRAGMA journal_mode = DELETE")
+                db.execute("PRAGMA page_size = {}".format(DB_PAGE_SIZE))
+                db.execute("VACUUM")
+                db.execute("PRAGMA journal_mode = WAL")
+                self.vacuum = False
+            DbFactory.checked_db_paths.add(self.db_path)
+            return db
 
     def update_schema(self, c: sqlite3.Cursor):
         current_schema_version = None
@@ -434,4 +1211,69 @@ class DbFactory(api_interface.DbFactory):
             c.execute("update settings set value=4 where key = 'current_schema_version'")
             self.update_schema(c)
 
+        elif current_schema_version == 4:
+            c.execute("insert into settings (key, value, help, type, hidden) values('index_max_workers', 1, 'The number of directories indexed in parallel', 'int', 0)")
+            c.execute("insert into settings (key, value, help, type, hidden) values('index_max_memory_mb', 1024, 'The memory budget in MB for rendering pdf pages', 'int', 0)")
+            c.execute("insert into settings (key, value, help, type, hidden) values('index_nice', 10, 'The cpu and io niceness of the indexer (0-19)', 'int', 0)")
+            c.execute("insert into settings (key, value, help, type, hidden) values('index_search_pause', 5, 'Seconds the indexer pauses after a search', 'int', 0)")
+            c.execute("update settings set value=5 where key = 'current_schema_version'")
+            self.update_schema(c)
+
+        elif current_schema_version == 5:
+            c.execute("alter table images add column phash TEXT")
+            c.execute("alter table images add column ink REAL")
+            c.execute("CREATE INDEX images_phash ON images (phash)")
+            c.execute("insert into settings (key, value, help, type, hidden) values('blank_page_threshold', 20, 'Pages with less dark pixels per 10000 pixels are skipped as blank, 0 disables', 'int', 0)")
+            c.execute("insert into settings (key, value, help, type, hidden) values('duplicate_page_distance', 8, 'Max. number of differing hash bits (of 256) for a page to reuse the text of an indexed duplicate, -1 disables', 'int', 0)")
+            c.execute("update settings set value=6 where key = 'current_schema_version'")
+            self.update_schema(c)
+
+        elif current_schema_version == 6:
+            c.execute("insert into settings (key, value, help, type, hidden) values('pdf_dpi', 300, 'The resolution pdf pages are rendered with', 'int', 0)")
+            c.execute("update settings set value=7 where key = 'current_schema_version'")
+            self.update_schema(c)
+
+        elif current_schema_version == 7:
+            c.execute("alter table images add column dpi INTEGER")
+            c.execute("alter table images add column confidence REAL")
+            c.execute("insert into settings (key, value, help, type, hidden) values('pdf_low_dpi', 150, 'The resolution pdf pages are rendered with first, pages with a low confidence are rendered again with pdf_dpi, 0 disables', 'int', 0)")
+            c.execute("insert into settings (key, value, help, type, hidden) values('min_confidence', 60, 'Pages with a lower mean word confidence (0-100) are rendered again with pdf_dpi', 'int', 0)")
+            c.execute("update settings set value=8 where key = 'current_schema_version'")
+            self.update_schema(c)
+
+        elif current_schema_version == 8:
+            # one row per page with the packed words instead of one row per word
+            c.execute(
+                "CREATE TABLE pages ( image_id INTEGER PRIMARY KEY, text TEXT NOT NULL, words BLOB NOT NULL, FOREIGN KEY(image_id) REFERENCES images(id) ON DELETE CASCADE )")
+            rows = c.connection.execute("select image_id, text, left, top, width, height from texts order by image_id, id")
+            for image_id, words in itertools.groupby(rows, lambda row: row[0]):
+                c.execute("insert into pages (image_id, text, words) values (?, ?, ?)",
+                          (image_id,) + pack_words([row[1:] for row in words]))
+            c.execute("drop table texts")
+            self.vacuum = True
+            c.execute("update settings set value=9 where key = 'current_schema_version'")
+            self.update_schema(c)
+
+        elif current_schema_version == 9:
+            c.execute("insert into settings (key, value, help, type, hidden) values('profile_mode', null, 'Profiles index jobs and slow searches into the profiles directory: stages, cprofile or sample, empty disables', 'str', 0)")
+            c.execute("insert into settings (key, value, help, type, hidden) values('profile_sample_percent', 10, 'The share of index jobs and searches which are profiled in percent', 'int', 0)")
+            c.execute("insert into settings (key, value, help, type, hidden) values('profile_slow_query_ms', 200, 'Searches and queries taking longer are profiled with their query plan', 'int', 0)")
+            c.execute("update settings set value=10 where key = 'current_schema_version'")
+            self.update_schema(c)
+
+        elif current_schema_version == 10:
+            # near duplicates are checked pixel by pixel now, but only exact hash matches are reused by default
+            c.execute("update settings set value=0 where key = 'duplicate_page_distance' and value = '8'")
+            c.execute("update settings set help='Max. number of differing hash bits (of 256) for a page to reuse the text of an indexed duplicate, larger values are confirmed by comparing the pages, -1 disables' where key = 'duplicate_page_distance'")
+            c.execute("update settings set value=11 where key = 'current_schema_version'")
+            self.update_schema(c)
+
+        elif current_schema_version == 11:
+            # ink is measured against the surrounding of a pixel now, the stored values are measured again
+            c.execute("update images set ink = NULL")
+            c.execute("update settings set value=3 where key = 'blank_page_threshold' and value = '20'")
+            c.execute("update settings set help='Pages with less ink pixels (clearly darker than their surrounding) per 10000 pixels are skipped as blank, 0 disables' where key = 'blank_page_threshold'")
+            c.execute("update settings set value=12 where key = 'current_schema_version'")
+            self.update_schema(c)
+
 
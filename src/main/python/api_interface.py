@@ -1,10 +1,78 @@
 import abc
-from typing import List, Dict, Tuple
-import numpy as np
+from typing import List, Dict, Tuple, Callable, Iterator, TYPE_CHECKING
 import sqlite3
 
+if TYPE_CHECKING:
+    import numpy as np
+    import profiling
+
 
 # ABSTRACT DESIGN
+class IndexEvent:
+    # progress of an index job. events are formatted by their consumers, not by the job.
+    SCANNING = "scanning"
+    SCANNED = "scanned"
+    FILE_STARTED = "file_started"
+    PAGE_DONE = "page_done"
+    FILE_DONE = "file_done"
+    INFO = "info"
+    ERROR = "error"
+    FINISHED = "finished"
+
+    # details of PAGE_DONE
+    UNCHANGED = "unchanged"
+    BLANK = "blank"
+    DUPLICATE = "duplicate"
+    OCR = "ocr"
+    OCR_HIGH_DPI = "ocr_high_dpi"
+
+    # details of FINISHED
+    DONE = "done"
+    STOPPED = "stopped"
+    FAILED = "failed"
+
+    __slots__ = ("kind", "path", "current", "total", "detail", "root")
+
+    def __init__(self, kind: str, path: str = None, current: int = None, total: int = None, detail=None,
+                 root: str = None):
+        self.kind = kind
+        self.path = path
+        self.current = current
+        self.total = total
+        self.detail = detail
+        # the indexed directory, messages show the paths relative to it
+        self.root = root
+
+    def get_relative_path(self) -> str:
+        if self.path and self.root and self.path.startswith(self.root + "/"):
+            return self.path[len(self.root) + 1:]
+        return self.path
+
+    def __str__(self):
+        if self.kind == IndexEvent.SCANNING:
+            return "Scanning files in {}".format(self.path)
+        if self.kind == IndexEvent.SCANNED:
+            return "Scanning files finished. Found {} files for indexing.".format(self.total)
+        if self.kind == IndexEvent.FILE_STARTED:
+            return "File {} of {}: Analyzing {}.".format(self.current + 1, self.total, self.get_relative_path())
+        if self.kind == IndexEvent.PAGE_DONE:
+            return {IndexEvent.UNCHANGED: "Skipping already indexed file {}.",
+                    IndexEvent.BLANK: "Skipping blank page {}.",
+                    IndexEvent.DUPLICATE: "Reusing text of a duplicate page for {}.",
+                    IndexEvent.OCR_HIGH_DPI: "Extracted text from {} after rendering it again because of a low confidence."
+                    }.get(self.detail, "Extracted text from {}.").format(self.get_relative_path())
+        if self.kind == IndexEvent.FILE_DONE:
+            return "Merged {} from worker {}.".format(self.get_relative_path(), self.detail)
+        if self.kind == IndexEvent.ERROR:
+            if self.path:
+                return "An unknown error occured while processing {}: {}".format(self.get_relative_path(), self.detail)
+            return "An unknown error occured: {}".format(self.detail)
+        if self.kind == IndexEvent.FINISHED:
+            return {IndexEvent.STOPPED: "Indexing stopped", IndexEvent.FAILED: "Indexing failed"}.get(
+                self.detail, "Indexing successfully finished")
+        return str(self.detail)
+
+
 class IndexJob:
     @abc.abstractmethod
     def start(self):
@@ -27,7 +95,22 @@ class IndexJob:
         return None
 
     @abc.abstractmethod
-    def get_messages(self) -> List[str]:
+    def add_listener(self, listener: Callable[[IndexEvent], None]):
+        # the listener is called by the job thread for every event
+        return None
+
+    @abc.abstractmethod
+    def remove_listener(self, listener: Callable[[IndexEvent], None]):
+        return None
+
+    @abc.abstractmethod
+    def get_events(self) -> List[IndexEvent]:
+        # returns and removes the buffered events
+        return None
+
+    @abc.abstractmethod
+    def iter_events(self, timeout: float = None) -> Iterator[IndexEvent]:
+        # yields the buffered and the following events until the job finished or no event came within the timeout
         return None
 
     @abc.abstractmethod
@@ -35,13 +118,52 @@ class IndexJob:
         return False
 
     @abc.abstractmethod
-    def get_settings(self) -> Dict[str, Tuple[str, str, str]]:
+    def get_settings(self) -> Dict[str, object]:
         return None
 
     @abc.abstractmethod
-    def set_settings(self, settings: Dict[str, str]):
+    def set_settings(self, settings: Dict[str, object]):
+        return None
+
+    @abc.abstractmethod
+    def set_resource_limits(self, nice: int = None, max_memory_mb: int = None, throttle: Callable[[], None] = None):
+        return None
+
+    @abc.abstractmethod
+    def set_profiler(self, profiler: 'profiling.Profiler'):
+        return None
+
+
+class IndexScheduler:
+    @abc.abstractmethod
+    def submit(self, job: IndexJob, priority=0):
+        return None
+
+    @abc.abstractmethod
+    def cancel(self, job: IndexJob):
+        return None
+
+    @abc.abstractmethod
+    def get_jobs(self) -> List[IndexJob]:
         return None
 
+    @abc.abstractmethod
+    def get_running_jobs(self) -> List[IndexJob]:
+        return None
+
+    @abc.abstractmethod
+    def is_idle(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def set_limits(self, max_workers=None, max_memory_mb=None, nice=None, search_pause=None):
+        return None
+
+    @abc.abstractmethod
+    def notify_interactive(self):
+        return None
+
+
 class Result:
     @abc.abstractmethod
     def get_path(self) -> str:
@@ -56,7 +178,7 @@ class Result:
         return None
 
     @abc.abstractmethod
-    def get_preview_image(self) -> np.ndarray:
+    def get_preview_image(self) -> 'np.ndarray':
         return None
 
 
@@ -89,6 +211,26 @@ class WheresTheFckReceipt:
     def get_last_directory(self) -> str:
         return None
 
+    @abc.abstractmethod
+    def get_scheduler(self) -> IndexScheduler:
+        return None
+
+    @abc.abstractmethod
+    def get_setting(self, key):
+        return None
+
+    @abc.abstractmethod
+    def get_settings(self) -> Dict[str, Tuple[str, str, str]]:
+        return None
+
+    @abc.abstractmethod
+    def set_settings(self, settings: Dict[str, str]):
+        return None
+
+    @abc.abstractmethod
+    def add_settings_listener(self, listener: Callable[[Dict[str, object]], None]):
+        return None
+
 
 class DbFactory:
 
@@ -96,11 +238,20 @@ class DbFactory:
     def create(self) -> sqlite3.Connection:
         return None
 
+    @abc.abstractmethod
+    def get_generation(self) -> int:
+        return None
+
+    @abc.abstractmethod
+    def bump_generation(self):
+        pass
+
 
 class IndexJobFactory:
 
     @abc.abstractmethod
-    def create(self, path: str, db_factory: DbFactory, app_data_dir: str, poppler_path=None, tesseract_exe=None) -> IndexJob:
+    def create(self, path: str, db_factory: DbFactory, app_data_dir: str, poppler_path=None, tesseract_exe=None,
+               blank_threshold=None, duplicate_distance=None) -> IndexJob:
         return None
 
 
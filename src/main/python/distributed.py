@@ -0,0 +1,579 @@
+import hashlib
+import multiprocessing
+import os
+import queue
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from multiprocessing.connection import Listener, Client, Connection
+from typing import List, Dict, Tuple, Callable, Iterator
+
+import api
+import api_interface
+import profiling
+from api_interface import IndexEvent
+
+
+class TaskQueue:
+    # durable file based queue of files to index; tasks are leased to workers and retried when the lease expires
+
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.mutex = threading.Lock()
+        self.db = None  # type: sqlite3.Connection
+
+    def open(self):
+        if not os.path.exists(os.path.dirname(self.db_path)):
+            os.makedirs(os.path.dirname(self.db_path))
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        c = self.db.cursor()
+        c.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ( id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, lease_owner TEXT, lease_expires REAL, error TEXT )")
+        c.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)")
+        self.db.commit()
+
+    def close(self):
+        # waits for the running calls, the serve threads of a coordinator may still lease or renew
+        with self.mutex:
+            if self.db:
+                self.db.close()
+                self.db = None
+
+    def enqueue(self, paths: List[str]):
+        with self.mutex:
+            c = self.db.cursor()
+            # tasks of an interrupted run are kept and resumed, finished ones are dropped
+            c.execute("delete from tasks where state in (?, ?)", (TaskQueue.DONE, TaskQueue.FAILED))
+            c.execute("update tasks set state = ?, lease_owner = NULL, lease_expires = NULL where state = ?",
+                      (TaskQueue.PENDING, TaskQueue.LEASED))
+            c.executemany("insert or ignore into tasks (path, state) values (?, ?)",
+                          [(path, TaskQueue.PENDING) for path in paths])
+            self.db.commit()
+
+    def lease(self, worker_id, max_tasks=1) -> List[Tuple[int, str]]:
+        with self.mutex:
+            if self.db is None:
+                return []
+            c = self.db.cursor()
+            self.__expire_leases(c)
+            rows = c.execute("select id, path from tasks where state = ? order by id limit ?",
+                             (TaskQueue.PENDING, max_tasks)).fetchall()
+            expires = time.time() + self.lease_seconds
+            c.executemany(
+                "update tasks set state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1 where id = ?",
+                [(TaskQueue.LEASED, worker_id, expires, row[0]) for row in rows])
+            self.db.commit()
+            return [(row[0], row[1]) for row in rows]
+
+    def renew(self, worker_id, task_ids: List[int]):
+        with self.mutex:
+            if self.db is None:
+                return
+            expires = time.time() + self.lease_seconds
+            self.db.executemany("update tasks set lease_expires = ? where id = ? and state = ? and lease_owner = ?",
+                                [(expires, task_id, TaskQueue.LEASED, worker_id) for task_id in task_ids])
+            self.db.commit()
+
+    def complete(self, worker_id, task_id) -> bool:
+        # returns False if the lease was lost in the meantime, the result must be dropped then
+        with self.mutex:
+            c = self.db.cursor()
+            c.execute("update tasks set state = ?, lease_owner = NULL, lease_expires = NULL where id = ? and state = ? and lease_owner = ?",
+                      (TaskQueue.DONE, task_id, TaskQueue.LEASED, worker_id))
+            self.db.commit()
+            return c.rowcount == 1
+
+    def fail(self, worker_id, task_id, error):
+        with self.mutex:
+            c = self.db.cursor()
+            c.execute(
+                "update tasks set state = case when attempts >= ? then ? else ? end, lease_owner = NULL, lease_expires = NULL, error = ? where id = ? and state = ? and lease_owner = ?",
+                (self.max_attempts, TaskQueue.FAILED, TaskQueue.PENDING, error, task_id, TaskQueue.LEASED, worker_id))
+            self.db.commit()
+
+    def counts(self) -> Dict[str, int]:
+        with self.mutex:
+            c = self.db.cursor()
+            self.__expire_leases(c)
+            self.db.commit()
+            counts = {TaskQueue.PENDING: 0, TaskQueue.LEASED: 0, TaskQueue.DONE: 0, TaskQueue.FAILED: 0}
+            for row in c.execute("select state, count(*) from tasks group by state").fetchall():
+                counts[row[0]] = row[1]
+            return counts
+
+    def __expire_leases(self, c: sqlite3.Cursor):
+        now = time.time()
+        c.execute(
+            "update tasks set state = case when attempts >= ? then ? else ? end, lease_owner = NULL, lease_expires = NULL, error = 'lease expired' where state = ? and lease_expires < ?",
+            (self.max_attempts, TaskQueue.FAILED, TaskQueue.PENDING, TaskQueue.LEASED, now))
+
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+def check_authkey(address, authkey: bytes = None) -> bytes:
+    # the listener unpickles every message, so the authkey is all that keeps others from running code on the
+    # coordinator. a random key is generated for local workers, a coordinator reachable from other machines needs
+    # an explicit key.
+    if authkey:
+        return authkey
+    if address[0] not in LOCAL_HOSTS:
+        raise ValueError("An authkey is required for a coordinator listening on {}".format(address[0]))
+    return os.urandom(32)
+
+
+class Coordinator(api_interface.IndexJob):
+    # enumerates the files of a directory into a TaskQueue and merges the results sent back by the workers
+
+    def __init__(self, path, db_factory: api_interface.DbFactory, app_data_path, poppler_path=None,
+                 tesseract_exe=None, blank_threshold=None, duplicate_distance=None, address=("localhost", 0),
+                 authkey: bytes = None, num_local_workers=0, lease_seconds=600, max_attempts=3):
+        self.path = path
+        self.db_factory = db_factory
+        self.app_data_path = app_data_path
+        self.poppler_path = poppler_path
+        self.tesseract_exe = tesseract_exe
+        self.blank_threshold = blank_threshold
+        # duplicates are only detected within a file on the workers
+        self.duplicate_distance = duplicate_distance
+        self.dpi = 300
+        self.low_dpi = None
+        self.min_confidence = None
+        self.address = address
+        self.authkey = check_authkey(address, authkey)
+        self.num_local_workers = num_local_workers
+        self.queue = TaskQueue(app_data_path + "/queue_" + hashlib.md5(path.encode('utf-8')).hexdigest() + ".sqlite3",
+                               lease_seconds, max_attempts)
+
+        self._stop = False
+        self.events = api.EventChannel(path)
+        self.throttle = None  # type: Callable[[], None]
+        self.profiler = None  # type: profiling.Profiler
+        self.profile = profiling.NULL_PROFILE  # type: profiling.Profile
+
+        self.listener = None  # type: Listener
+        self.local_workers = []  # type: List[multiprocessing.Process]
+        self.__db = None  # type: sqlite3.Connection
+        self.__dir_id = None
+        # results are merged by the thread owning the database connection
+        self.__results = queue.Queue()
+
+    def start(self):
+        # init vars
+        self._stop = False
+        self.events.reset()
+        # start thread
+        thread = threading.Thread(target=self.run, args=())
+        thread.daemon = True  # Daemonize thread
+        thread.start()  # Start the execution
+
+    def stop(self):
+        self._stop = True
+
+    def get_path(self) -> str:
+        return self.path
+
+    def get_curr_file_index(self) -> int:
+        return self.events.get_progress()[0]
+
+    def get_num_files(self) -> int:
+        return self.events.get_progress()[1]
+
+    def add_listener(self, listener: Callable[[IndexEvent], None]):
+        self.events.add_listener(listener)
+
+    def remove_listener(self, listener: Callable[[IndexEvent], None]):
+        self.events.remove_listener(listener)
+
+    def get_events(self) -> List[IndexEvent]:
+        return self.events.drain()
+
+    def iter_events(self, timeout: float = None) -> Iterator[IndexEvent]:
+        return self.events.iterate(timeout)
+
+    def is_finished(self) -> bool:
+        return self.events.get_progress()[2]
+
+    def set_resource_limits(self, nice: int = None, max_memory_mb: int = None, throttle: Callable[[], None] = None):
+        # the limits of the workers are set on their own machines, only merging is throttled here
+        self.throttle = throttle
+
+    def set_profiler(self, profiler: profiling.Profiler):
+        # only scanning and merging are profiled, the workers run on their own machines
+        self.profiler = profiler
+
+    def get_settings(self) -> Dict[str, object]:
+        return {"poppler_path": self.poppler_path, "tesseract_exe": self.tesseract_exe,
+                "blank_page_threshold": self.blank_threshold, "duplicate_page_distance": self.duplicate_distance,
+                "pdf_dpi": self.dpi, "pdf_low_dpi": self.low_dpi, "min_confidence": self.min_confidence}
+
+    def set_settings(self, settings: Dict[str, object]):
+        # sent to the workers when they connect and with every lease
+        if "poppler_path" in settings:
+            self.poppler_path = settings["poppler_path"]
+        if "tesseract_exe" in settings:
+            self.tesseract_exe = settings["tesseract_exe"]
+        if "blank_page_threshold" in settings:
+            self.blank_threshold = settings["blank_page_threshold"]
+        if "duplicate_page_distance" in settings:
+            self.duplicate_distance = settings["duplicate_page_distance"]
+        if settings.get("pdf_dpi"):
+            self.dpi = settings["pdf_dpi"]
+        if "pdf_low_dpi" in settings:
+            self.low_dpi = settings["pdf_low_dpi"]
+        if "min_confidence" in settings:
+            self.min_confidence = settings["min_confidence"]
+
+    def get_address(self) -> Tuple[str, int]:
+        return self.listener.address if self.listener else None
+
+    def __pending_files(self, c: sqlite3.Cursor, scan_files: List[str]) -> List[str]:
+        # files which are not indexed yet or have pages skipped as blank which are checked again
+        indexed = set()
+        recheck = set()
+        rows = c.execute(
+            "select images.path, documents.path, images.ink, images.confidence, exists (select 1 from pages where pages.image_id = images.id) from images left join documents on documents.id = images.document_id where images.directory_id = ?",
+            (self.__dir_id,))
+        for path, doc_path, ink, confidence, has_words in rows:
+            indexed.add(doc_path or path)
+            if api.recheck_blank(ink, confidence, has_words, self.blank_threshold):
+                recheck.add(doc_path or path)
+        return [path for path in scan_files if path not in indexed or path in recheck]
+
+    def run(self):
+        result = IndexEvent.FAILED
+        self.profile = self.profiler.create("coordinator").start() if self.profiler else profiling.NULL_PROFILE
+        try:
+            self.__db = self.db_factory.create()
+            c = self.__db.cursor()
+            self.__dir_id = api.get_directory_id(c, self.path)
+            self.__db.commit()
+
+            # collect files
+            self.events.publish(IndexEvent(IndexEvent.SCANNING, self.path))
+            with self.profile.stage("scan"):
+                scan_files = self.__pending_files(c, api.find_files(self.path, lambda: self._stop))
+            self.queue.open()
+            self.queue.enqueue(scan_files)
+            counts = self.queue.counts()
+            num_files = sum(counts.values())
+            self.events.publish(IndexEvent(IndexEvent.SCANNED, total=num_files))
+
+            # serve workers
+            self.listener = Listener(self.address, authkey=self.authkey)
+            accept_thread = threading.Thread(target=self.__accept, args=())
+            accept_thread.daemon = True
+            accept_thread.start()
+            self.events.publish(IndexEvent(IndexEvent.INFO, detail="Waiting for workers on {}:{}".format(
+                *self.listener.address)))
+            for i in range(self.num_local_workers):
+                worker = multiprocessing.Process(target=run_worker, args=(self.listener.address, self.authkey))
+                worker.daemon = True
+                worker.start()
+                self.local_workers.append(worker)
+
+            while not self._stop:
+                if self.throttle:
+                    self.throttle()
+                self.__merge_results(0.5)
+                counts = self.queue.counts()
+                if counts[TaskQueue.PENDING] == 0 and counts[TaskQueue.LEASED] == 0:
+                    break
+
+            result = IndexEvent.STOPPED if self._stop else IndexEvent.DONE
+        except:
+            self._stop = True
+            self.events.publish(IndexEvent(IndexEvent.ERROR, detail=sys.exc_info()[0]))
+        finally:
+            self.__shutdown()
+            profile_path = self.profile.finish()
+            if profile_path:
+                self.events.publish(IndexEvent(IndexEvent.INFO, detail="Wrote profile to " + profile_path))
+            self.events.publish(IndexEvent(IndexEvent.FINISHED, detail=result))
+
+    def __shutdown(self):
+        if self.listener:
+            listener = self.listener
+            self.listener = None
+            # wake up the accept thread before closing the socket
+            try:
+                Client(listener.address, authkey=self.authkey).close()
+            except:
+                pass
+            listener.close()
+        for worker in self.local_workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        self.local_workers = []
+        self.queue.close()
+        if self.__db:
+            self.__db.close()
+            self.__db = None
+
+    def __accept(self):
+        while True:
+            listener = self.listener
+            if listener is None:
+                return
+            try:
+                conn = listener.accept()
+            except:
+                if self.listener is None:
+                    return
+                continue
+            if self.listener is None:
+                conn.close()
+                return
+            thread = threading.Thread(target=self.__serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def __config(self) -> Dict[str, object]:
+        return {"app_data_path": self.app_data_path, "poppler_path": self.poppler_path,
+                "tesseract_exe": self.tesseract_exe, "blank_threshold": self.blank_threshold,
+                "duplicate_distance": self.duplicate_distance, "dpi": self.dpi, "low_dpi": self.low_dpi,
+                "min_confidence": self.min_confidence, "root": self.path, "lease_seconds": self.queue.lease_seconds}
+
+    def __serve(self, conn: Connection):
+        try:
+            while True:
+                message = conn.recv()
+                command = message[0]
+                if command == "hello":
+                    conn.send(self.__config())
+                elif command == "lease":
+                    _, worker_id, max_tasks = message
+                    if self._stop or self.listener is None:
+                        conn.send(None)
+                        return
+                    # the settings may have changed since the worker connected
+                    conn.send((self.queue.lease(worker_id, max_tasks), self.__config()))
+                elif command == "renew":
+                    _, worker_id, task_ids = message
+                    if self._stop or self.listener is None:
+                        conn.send(None)
+                        return
+                    self.queue.renew(worker_id, task_ids)
+                    conn.send(True)
+                elif command == "result":
+                    _, worker_id, task_id, pages = message
+                    self.__results.put((worker_id, task_id, pages))
+                    conn.send(True)
+                elif command == "fail":
+                    _, worker_id, task_id, error = message
+                    if self._stop or self.listener is None:
+                        conn.send(None)
+                        return
+                    self.queue.fail(worker_id, task_id, error)
+                    self.events.publish(IndexEvent(IndexEvent.ERROR, "task {} on worker {}".format(task_id, worker_id),
+                                                   detail=error))
+                    conn.send(True)
+                else:
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def __merge_results(self, timeout):
+        try:
+            result = self.__results.get(timeout=timeout)
+        except queue.Empty:
+            return
+        c = self.__db.cursor()
+        merged = []
+        with self.profile.stage("merge"):
+            while result is not None:
+                worker_id, task_id, pages = result
+                if self.queue.complete(worker_id, task_id):
+                    for page in pages:
+                        existing = c.execute(
+                            "select id, ink, confidence, exists (select 1 from pages where pages.image_id = images.id) from images where path = ?",
+                            (page.path,)).fetchone()
+                        if existing is not None:
+                            if not api.recheck_blank(existing[1], existing[2], existing[3], self.blank_threshold):
+                                continue
+                            page.replace_id = existing[0]
+                        api.store_page(c, self.__dir_id, page)
+                    if pages:
+                        merged.append((pages[0].doc_path or pages[0].path, worker_id))
+                try:
+                    result = self.__results.get_nowait()
+                except queue.Empty:
+                    result = None
+            self.__db.commit()
+        self.db_factory.bump_generation()
+        counts = self.queue.counts()
+        done = counts[TaskQueue.DONE] + counts[TaskQueue.FAILED]
+        for path, worker_id in merged:
+            self.events.publish(IndexEvent(IndexEvent.FILE_DONE, path, done, detail=worker_id))
+
+
+class CoordinatorFactory(api_interface.IndexJobFactory):
+
+    def __init__(self, address=("localhost", 0), authkey: bytes = None, num_local_workers=0):
+        self.address = address
+        # one key for all coordinators so that remote workers can connect to every directory
+        self.authkey = check_authkey(address, authkey)
+        self.num_local_workers = num_local_workers
+
+    def create(self, path, db_factory: api_interface.DbFactory, app_data_dir, poppler_path=None,
+               tesseract_exe=None, blank_threshold=None, duplicate_distance=None) -> Coordinator:
+        return Coordinator(path, db_factory, app_data_dir, poppler_path, tesseract_exe, blank_threshold,
+                           duplicate_distance, self.address, self.authkey, self.num_local_workers)
+
+
+class Worker:
+    # pulls tasks from a Coordinator, runs the ocr and sends the words back
+
+    def __init__(self, address, authkey: bytes, app_data_path=None, poppler_path=None, tesseract_exe=None,
+                 batch_size=1):
+        self.address = address
+        self.authkey = authkey
+        # paths set on this node win over the ones of the coordinator
+        self.local_paths = (app_data_path, poppler_path, tesseract_exe)
+        self.app_data_path = app_data_path
+        self.poppler_path = poppler_path
+        self.tesseract_exe = tesseract_exe
+        self.batch_size = batch_size
+        self.blank_threshold = None
+        self.duplicate_distance = None
+        self.dpi = 300
+        self.low_dpi = None
+        self.min_confidence = None
+        self.lease_seconds = 600
+        self.worker_id = socket.gethostname() + "-" + str(os.getpid()) + "-" + uuid.uuid4().hex[:8]
+
+    def process(self, path) -> List[api.Page]:
+        _, ext = os.path.splitext(path)
+        if ext.lower() == ".pdf":
+            dpi = self.low_dpi if self.low_dpi and self.low_dpi < self.dpi else self.dpi
+            pages = api.pdf_to_images(path, self.app_data_path, self.poppler_path, dpi=dpi)
+        else:
+            pages = [api.Page(path)]
+        processed_pages = []
+        file_pages = api.FilePages()
+        for page in pages:
+            processed_pages.append(page)
+            if page.image is None:
+                page.image = api.load_gray(page.path)
+            if page.fingerprint is None:
+                page.fingerprint = api.page_fingerprint(page.image)
+            find_duplicates = self.duplicate_distance is not None and self.duplicate_distance >= 0
+            duplicate = None
+            blank = api.is_blank(page.fingerprint, self.blank_threshold)
+            if not blank and find_duplicates:
+                duplicate = file_pages.find(page)
+            if blank:
+                page.words = []
+            elif duplicate is not None:
+                api.reuse_words(page, duplicate.words, duplicate.dpi, duplicate.confidence)
+            else:
+                api.ocr_page(page, self.min_confidence, self.dpi, self.poppler_path)
+                if find_duplicates:
+                    file_pages.add(page)
+            # the images are not sent to the coordinator
+            api.save_preview(page)
+            page.image = None
+        return processed_pages
+
+    def configure(self, config: Dict[str, object]):
+        # applies the settings of the coordinator, paths to the executables may differ between nodes
+        app_data_path, poppler_path, tesseract_exe = self.local_paths
+        self.app_data_path = app_data_path or config["app_data_path"]
+        self.poppler_path = poppler_path or config["poppler_path"]
+        self.tesseract_exe = tesseract_exe or config["tesseract_exe"]
+        self.blank_threshold = config["blank_threshold"]
+        self.duplicate_distance = config["duplicate_distance"]
+        self.dpi = config["dpi"]
+        self.low_dpi = config["low_dpi"]
+        self.min_confidence = config["min_confidence"]
+        self.lease_seconds = config["lease_seconds"]
+        if self.tesseract_exe:
+            api.set_tesseract_exe(self.tesseract_exe)
+
+    def __heartbeat(self, conn: Connection, mutex: threading.Lock, task_ids: List[int], stop: threading.Event):
+        # renews the leases of the tasks of the batch while they are processed
+        interval = max(self.lease_seconds / 3.0, 0.1)
+        while not stop.wait(interval):
+            with mutex:
+                if stop.is_set() or not task_ids:
+                    continue
+                try:
+                    conn.send(("renew", self.worker_id, list(task_ids)))
+                    conn.recv()
+                except (EOFError, OSError):
+                    return
+
+    def run(self):
+        conn = Client(self.address, authkey=self.authkey)
+        # the connection is shared with the heartbeat thread
+        mutex = threading.Lock()
+        stop = threading.Event()
+        try:
+            conn.send(("hello", self.worker_id))
+            self.configure(conn.recv())
+
+            task_ids = []  # type: List[int]
+            heartbeat = threading.Thread(target=self.__heartbeat, args=(conn, mutex, task_ids, stop))
+            heartbeat.daemon = True
+            heartbeat.start()
+            while True:
+                with mutex:
+                    conn.send(("lease", self.worker_id, self.batch_size))
+                    reply = conn.recv()
+                    if reply is None:
+                        break
+                    tasks, config = reply
+                    self.configure(config)
+                    task_ids.extend(task[0] for task in tasks)
+                if not tasks:
+                    # the remaining tasks are leased by other workers, they come back if a lease expires
+                    time.sleep(1)
+                    continue
+                for task_id, path in tasks:
+                    try:
+                        message = ("result", self.worker_id, task_id, self.process(path))
+                    except:
+                        message = ("fail", self.worker_id, task_id, str(sys.exc_info()[1]))
+                    with mutex:
+                        task_ids.remove(task_id)
+                        conn.send(message)
+                        conn.recv()
+        except (EOFError, OSError):
+            pass
+        finally:
+            stop.set()
+            with mutex:
+                conn.close()
+
+
+def run_worker(address, authkey: bytes, app_data_path=None, poppler_path=None, tesseract_exe=None, batch_size=1):
+    Worker(address, authkey, app_data_path, poppler_path, tesseract_exe, batch_size).run()
+
+
+if __name__ == '__main__':
+    # usage: python distributed.py host:port authkey [num_processes]
+    if len(sys.argv) < 3:
+        sys.exit("usage: python distributed.py host:port authkey [num_processes]")
+    host, port = sys.argv[1].rsplit(":", 1)
+    authkey = sys.argv[2].encode("utf-8")
+    num_processes = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    processes = []
+    for i in range(num_processes):
+        process = multiprocessing.Process(target=run_worker, args=((host, int(port)), authkey))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
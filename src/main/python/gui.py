@@ -5,8 +5,8 @@ import subprocess
 import sys
 import abc
 import time
+from typing import Callable, Dict, List
 
-import cv2
 from PyQt5 import QtGui, QtWidgets
 
 from PyQt5.QtCore import QDateTime, QStandardPaths, QFile, QFileInfo, Qt, QObject, QThread, pyqtSignal, QTimer, \
@@ -17,23 +17,46 @@ from PyQt5.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QLabel, QListWidg
     QTabWidget, QTextEdit, QApplication, QProgressBar, QFileDialog, QMessageBox, QLineEdit, QTableWidget, QSpinBox, \
     QHeaderView, QTableWidgetItem, QAbstractItemView, QSplitter, QCheckBox
 
-from pytesseract import pytesseract, Output
 import api_interface
 
 
+class IndexEvents(QObject):
+    # delivers the events of index jobs as queued signals to the gui thread
+    event = pyqtSignal(object)
+
+    def publish(self, event: api_interface.IndexEvent):
+        self.event.emit(event)
+
+    def listen(self, index_job: api_interface.IndexJob):
+        index_job.add_listener(self.publish)
+
+    def unlisten(self, index_job: api_interface.IndexJob):
+        index_job.remove_listener(self.publish)
+
+
 class Indexer(QWidget):
     def __init__(self, wheres_the_fck_receipt: api_interface.WheresTheFckReceipt, parent=None):
         QWidget.__init__(self, parent=None)
         self.wheres_the_fck_receipt = wheres_the_fck_receipt
-        self.index_job = None  # type: api_interface.IndexJob
-        self.index_job_timer = QTimer()
-        self.index_job_timer.timeout.connect(self.index_job_timer_timeout)
+        self.index_jobs = []  # type: List[api_interface.IndexJob]
+        # cancelled jobs which still finish their current page, and what to do with their directory afterwards
+        self.stopping_jobs = []  # type: List[api_interface.IndexJob]
+        self.pending_actions = {}  # type: Dict[str, Callable[[], None]]
+        self.index_events = IndexEvents()
+        self.index_events.event.connect(self.index_event)
 
         # WIDGETS
         # add dir button
         self.add_directory = QPushButton('Add Directory')
         self.add_directory.setEnabled(True)
         self.add_directory.clicked.connect(self.add_directory_clicked)
+        self.priority = QSpinBox()
+        self.priority.setRange(-10, 10)
+        add_directory_layout = QHBoxLayout()
+        add_directory_layout.setContentsMargins(0, 0, 0, 0)
+        add_directory_layout.addWidget(self.add_directory)
+        add_directory_layout.addWidget(QLabel("Priority"))
+        add_directory_layout.addWidget(self.priority)
 
         # locations
         self.directories = QListWidget()
@@ -79,7 +102,7 @@ class Indexer(QWidget):
         # layout
         layout = QVBoxLayout()
         layout.addWidget(QLabel("Indexed Directories:"))
-        layout.addWidget(self.add_directory)
+        layout.addLayout(add_directory_layout)
         layout.addWidget(self.directories)
         layout.addWidget(self.file_list_action_bar_widget)
         layout.addWidget(QLabel("Indexer Status:"))
@@ -89,7 +112,8 @@ class Indexer(QWidget):
 
     def directories_selection_changed(self):
         list_items = self.directories.selectedItems()
-        self.file_list_action_bar_widget.setEnabled(len(list_items) == 1)
+        self.file_list_action_bar_widget.setEnabled(
+            len(list_items) == 1 and list_items[0].text() not in self.pending_actions)
 
     def add_directory_clicked(self):
         directory = str(QFileDialog.getExistingDirectory(self, "Select Directory",
@@ -99,60 +123,99 @@ class Indexer(QWidget):
             # get the job
             if not self.directories.findItems(directory, Qt.MatchExactly):
                 self.directories.addItem(directory)
-            self.index_job = self.wheres_the_fck_receipt.add_directory(directory)
-            self.run_indexer()
+            self.run_indexer(self.wheres_the_fck_receipt.add_directory(directory))
 
-    def run_indexer(self):
+    def run_indexer(self, index_job: api_interface.IndexJob):
         # manage gui
-        self.add_directory.setEnabled(False)
-        self.directories.setEnabled(False)
-        self.file_list_action_bar_widget.setEnabled(False)
-        self.index_progress.setEnabled(True)
-        self.index_progress.reset()
-        self.stop_index.setEnabled(True)
-        # self.index_console.setEnabled(True)
-        self.index_console.clear()
-        # start job
+        if not self.index_jobs:
+            self.index_progress.setEnabled(True)
+            self.index_progress.reset()
+            self.index_console.clear()
         self.stop_index.setEnabled(True)
-        self.index_job.start()
-        self.index_job_timer.start(500)
+        # queue job
+        self.index_jobs.append(index_job)
+        self.index_events.listen(index_job)
+        self.wheres_the_fck_receipt.get_scheduler().submit(index_job, self.priority.value())
+        self.index_console.append("Queued {}.".format(index_job.get_path()))
+
+    def cancel_jobs(self, directory=None):
+        # cancels the jobs of the directory or all jobs. running jobs finish their current page first, they are
+        # listened to until then.
+        running = self.wheres_the_fck_receipt.get_scheduler().get_running_jobs()
+        for index_job in self.index_jobs:
+            if directory is None or index_job.get_path() == directory:
+                self.wheres_the_fck_receipt.get_scheduler().cancel(index_job)
+                if index_job in running and not index_job.is_finished():
+                    self.stopping_jobs.append(index_job)
+                else:
+                    self.index_events.unlisten(index_job)
+        self.index_jobs = [index_job for index_job in self.index_jobs
+                           if directory is not None and index_job.get_path() != directory]
+        if not self.index_jobs:
+            self.indexing_stopped()
+
+    def after_jobs_stopped(self, directory, action: Callable[[], None]):
+        # the directory must not be changed while a cancelled job still writes to it
+        self.cancel_jobs(directory)
+        self.pending_actions[directory] = action
+        self.run_pending_actions()
+
+    def run_pending_actions(self):
+        for index_job in [index_job for index_job in self.stopping_jobs if index_job.is_finished()]:
+            self.stopping_jobs.remove(index_job)
+            self.index_events.unlisten(index_job)
+        stopping = set(index_job.get_path() for index_job in self.stopping_jobs)
+        for directory in [directory for directory in self.pending_actions if directory not in stopping]:
+            self.pending_actions.pop(directory)()
+        self.directories_selection_changed()
 
     def update_clicked(self):
-        self.index_job = self.wheres_the_fck_receipt.update_directory(self.directories.currentItem().text())
-        self.run_indexer()
+        self.run_indexer(self.wheres_the_fck_receipt.update_directory(self.directories.currentItem().text()))
 
     def remove_clicked(self):
-        self.wheres_the_fck_receipt.remove_directory(self.directories.currentItem().text())
-        self.directories.takeItem(self.directories.currentRow())
+        directory = self.directories.currentItem().text()
+        self.after_jobs_stopped(directory, lambda: self.remove_directory(directory))
+
+    def remove_directory(self, directory):
+        self.wheres_the_fck_receipt.remove_directory(directory)
+        for item in self.directories.findItems(directory, Qt.MatchExactly):
+            self.directories.takeItem(self.directories.row(item))
 
     def reindex_clicked(self):
-        self.index_job = self.wheres_the_fck_receipt.reindex_directory(self.directories.currentItem().text())
-        self.run_indexer()
+        directory = self.directories.currentItem().text()
+        self.after_jobs_stopped(
+            directory, lambda: self.run_indexer(self.wheres_the_fck_receipt.reindex_directory(directory)))
 
     def stop_index_clicked(self):
-        self.index_job.stop()
-        self.indexing_stopped()
+        self.cancel_jobs()
 
     def indexing_stopped(self):
-        self.index_job_timer.stop()
-        self.add_directory.setEnabled(True)
-        self.directories.setEnabled(True)
-        self.file_list_action_bar_widget.setEnabled(len(self.directories.selectedItems()) > 0)
         self.index_progress.setEnabled(False)
         self.stop_index.setEnabled(False)
-        # self.index_console.setEnabled(False)
-        self.index_job = None
-
-    def index_job_timer_timeout(self):
-        for msg in self.index_job.get_messages():
-            self.index_console.append(msg)
-        num_files = self.index_job.get_num_files()
+        for index_job in self.index_jobs:
+            self.index_events.unlisten(index_job)
+        self.index_jobs = []
+
+    def index_event(self, event: api_interface.IndexEvent):
+        self.index_console.append(str(event))
+        if event.kind == api_interface.IndexEvent.FINISHED and self.stopping_jobs:
+            self.run_pending_actions()
+        if event.kind not in (api_interface.IndexEvent.SCANNED, api_interface.IndexEvent.FILE_STARTED,
+                              api_interface.IndexEvent.FILE_DONE, api_interface.IndexEvent.FINISHED):
+            return
+        num_files = 0
+        curr_file_idx = 0
+        for index_job in self.index_jobs:
+            job_num_files = index_job.get_num_files() or 0
+            num_files += job_num_files
+            if index_job.is_finished():
+                curr_file_idx += job_num_files
+            else:
+                curr_file_idx += index_job.get_curr_file_index() or 0
         if num_files and self.index_progress.maximum() != num_files:
             self.index_progress.setRange(0, num_files)
-        curr_file_idx = self.index_job.get_curr_file_index()
-        if curr_file_idx:
-            self.index_progress.setValue(curr_file_idx)
-        if self.index_job.is_finished():
+        self.index_progress.setValue(curr_file_idx)
+        if self.index_jobs and all(index_job.is_finished() for index_job in self.index_jobs):
             self.index_progress.setValue(self.index_progress.maximum())
             self.indexing_stopped()
 
@@ -167,8 +230,11 @@ class SearcherWidget(QWidget):
         # query
         self.query = QLineEdit()
         self.query.returnPressed.connect(self.search_button_clicked)
+        # pause indexing while the user types
+        self.query.textEdited.connect(self.query_edited)
         self.limit_box = QSpinBox()
-        self.limit_box.setValue(int(self.wheres_the_fck_receipt.get_settings()["default_limit"][0]))
+        self.limit_box.setValue(self.wheres_the_fck_receipt.get_setting("default_limit") or 0)
+        self.wheres_the_fck_receipt.add_settings_listener(self.settings_changed)
         self.cs_box = QCheckBox("Case Sensitive")
         search_button = QPushButton('Search')
         search_button.clicked.connect(self.search_button_clicked)
@@ -204,6 +270,15 @@ class SearcherWidget(QWidget):
         layout.addWidget(self.preview_widget)
         self.setLayout(layout)
 
+    def settings_changed(self, changed):
+        if "default_limit" in changed:
+            self.limit_box.setValue(changed["default_limit"] or 0)
+
+    def query_edited(self):
+        scheduler = self.wheres_the_fck_receipt.get_scheduler()
+        if scheduler:
+            scheduler.notify_interactive()
+
     def match_list_double_clicked(self, mi):
         row = mi.row()
         result = self.results[row]
@@ -309,16 +384,18 @@ class SettingsWidget(QTableWidget):
         self.wheres_the_fck_receipt.set_settings(settings)
 
 class WheresTheFckReceipt(QMainWindow):
+    # emitted when the tabs were built, i.e. the app is interactive
+    ready = pyqtSignal()
 
     def __init__(self, wheres_the_fck_receipt: api_interface.WheresTheFckReceipt, parent=None):
         QWidget.__init__(self, parent=None)
         self.wheres_the_fck_receipt = wheres_the_fck_receipt
+        self.first_paint_time = None
+        self.ready_time = None
 
-        # tab widget
+        # tab widget, the tabs need the database and are built after the window was painted the first time
         self.tab_widget = QTabWidget()
-        self.tab_widget.addTab(SettingsWidget(wheres_the_fck_receipt), "Settings")
-        self.tab_widget.addTab(Indexer(wheres_the_fck_receipt), "Indexer")
-        self.tab_widget.addTab(SearcherWidget(wheres_the_fck_receipt), "Searcher")
+        self.tab_widget.addTab(QLabel("Loading..."), "Loading")
 
         # build window title
         app_context = ApplicationContext()
@@ -330,3 +407,17 @@ class WheresTheFckReceipt(QMainWindow):
         self.setWindowTitle(window_title)
         self.setCentralWidget(self.tab_widget)
         self.resize(800, 600)
+
+    def paintEvent(self, event):
+        QMainWindow.paintEvent(self, event)
+        if self.first_paint_time is None:
+            self.first_paint_time = time.perf_counter()
+            QTimer.singleShot(0, self.build_tabs)
+
+    def build_tabs(self):
+        self.tab_widget.clear()
+        self.tab_widget.addTab(SettingsWidget(self.wheres_the_fck_receipt), "Settings")
+        self.tab_widget.addTab(Indexer(self.wheres_the_fck_receipt), "Indexer")
+        self.tab_widget.addTab(SearcherWidget(self.wheres_the_fck_receipt), "Searcher")
+        self.ready_time = time.perf_counter()
+        self.ready.emit()
@@ -1,3 +1,8 @@
+import time
+
+start_time = time.perf_counter()
+
+import multiprocessing
 import traceback
 
 from PyQt5.QtCore import QFileInfo, QStandardPaths
@@ -5,6 +10,9 @@ from fbs_runtime.application_context.PyQt5 import ApplicationContext
 
 import api_interface
 import api
+import distributed
+import profiling
+import scheduler
 import gui
 import sys
 
@@ -19,14 +27,48 @@ class AppDataDirPath(api_interface.AppDataDirPath):
 
 
 if __name__ == '__main__':
+    # the frozen app is started again as the local worker processes, they must not open a window
+    multiprocessing.freeze_support()
     # run the application
     app_context = ApplicationContext()
     delete_db = "--delete_db" in sys.argv
     app_data_dir_path = AppDataDirPath()
     db_factory = api.DbFactory(app_data_dir_path.get(), delete_db)
     index_job_factory = api.IndexJobFactory()
-    wheres_the_fck_receipt = gui.WheresTheFckReceipt(api.WheresTheFckReceipt(app_data_dir_path.get(), db_factory, index_job_factory))
+    # --coordinator=host:port lets workers on other machines join, --local_workers=n spawns worker processes,
+    # --authkey=key is required by a coordinator which listens on anything but localhost
+    coordinator_address = None
+    num_local_workers = 0
+    authkey = None
+    # --profile=stages|cprofile|sample profiles every index job and slow search regardless of the settings
+    profile_mode = None
+    for arg in sys.argv:
+        if arg.startswith("--coordinator="):
+            host, port = arg[len("--coordinator="):].rsplit(":", 1)
+            coordinator_address = (host, int(port))
+        elif arg.startswith("--local_workers="):
+            num_local_workers = int(arg[len("--local_workers="):])
+        elif arg.startswith("--authkey="):
+            authkey = arg[len("--authkey="):].encode("utf-8")
+        elif arg.startswith("--profile="):
+            profile_mode = arg[len("--profile="):]
+    if coordinator_address or num_local_workers:
+        try:
+            index_job_factory = distributed.CoordinatorFactory(coordinator_address or ("localhost", 0), authkey,
+                                                               num_local_workers)
+        except ValueError as e:
+            sys.exit(str(e))
+    profiler = profiling.Profiler(app_data_dir_path.get(), profile_mode) if profile_mode else None
+    wheres_the_fck_receipt = gui.WheresTheFckReceipt(api.WheresTheFckReceipt(app_data_dir_path.get(), db_factory, index_job_factory, scheduler.IndexScheduler(), profiler))
     #wheres_the_fck_receipt.show()
+    if "--benchmark_startup" in sys.argv:
+        # print the seconds until the first paint and until the app is interactive, then quit
+        def print_startup_time():
+            print("startup first_paint={:.3f} interactive={:.3f}".format(
+                wheres_the_fck_receipt.first_paint_time - start_time, wheres_the_fck_receipt.ready_time - start_time))
+            sys.stdout.flush()
+            app_context.app.quit()
+        wheres_the_fck_receipt.ready.connect(print_startup_time)
     wheres_the_fck_receipt.showMaximized()
     exit_code = int(app_context.app.exec_())  # 2. Invoke app_context.app.exec_()
     sys.exit(exit_code)
@@ -0,0 +1,192 @@
+import collections
+import contextlib
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from typing import List, Dict
+
+# modes of the profiler
+STAGES = "stages"  # wall and cpu time per stage, explain query plan of slow queries
+CPROFILE = "cprofile"  # additionally a cProfile of the profiled thread
+SAMPLE = "sample"  # additionally sampled stacks of the profiled thread in the folded flame graph format
+MODES = (STAGES, CPROFILE, SAMPLE)
+
+
+def children_time() -> float:
+    # cpu time of finished child processes like tesseract and poppler
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class Sampler:
+    # counts the stacks of a thread every interval seconds
+
+    def __init__(self, thread_id: int, interval=0.01):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.__stop = threading.Event()
+        self.__thread = None  # type: threading.Thread
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, args=())
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append("{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+class Profile:
+    # the stage times of one index job run or search. the profile belongs to the thread which started it.
+    # numbers the profiles so that their file names are unique
+    counter = itertools.count()
+
+    def __init__(self, name: str, mode: str, directory: str, slow_query_ms=None, min_wall=None):
+        self.name = name
+        self.mode = mode
+        self.directory = directory
+        self.slow_query_ms = slow_query_ms
+        # searches are only written if they took at least min_wall seconds
+        self.min_wall = min_wall
+        self.stages = {}  # type: Dict[str, List[float]]
+        self.slow_queries = []  # type: List[Dict[str, object]]
+        self.__start = None  # type: List[float]
+        self.__cprofile = None
+        self.__sampler = None  # type: Sampler
+
+    def start(self):
+        if self.mode == CPROFILE:
+            import cProfile
+            self.__cprofile = cProfile.Profile()
+            try:
+                self.__cprofile.enable()
+            except ValueError:
+                # since python 3.12 only one profiler may be active at a time, e.g. with parallel jobs
+                self.__cprofile = None
+        elif self.mode == SAMPLE:
+            self.__sampler = Sampler(threading.get_ident())
+            self.__sampler.start()
+        self.__start = [time.perf_counter(), time.thread_time(), children_time()]
+        return self
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        wall, cpu, children = time.perf_counter(), time.thread_time(), children_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = [0, 0.0, 0.0, 0.0]
+            stage[0] += 1
+            stage[1] += time.perf_counter() - wall
+            stage[2] += time.thread_time() - cpu
+            stage[3] += children_time() - children
+
+    def query(self, c: sqlite3.Cursor, sql: str, params, wall: float):
+        # keeps the query plan of a query which took wall seconds if it was slow
+        if self.slow_query_ms is None or wall * 1000 < self.slow_query_ms:
+            return
+        plan = [row[-1] for row in c.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        self.slow_queries.append({"sql": sql, "params": list(params), "wall": wall, "plan": plan})
+
+    def finish(self) -> str:
+        # writes the profile to the profiles directory and returns the path of the summary
+        wall = time.perf_counter() - self.__start[0]
+        cpu = time.thread_time() - self.__start[1]
+        children = children_time() - self.__start[2]
+        if self.__cprofile:
+            self.__cprofile.disable()
+        if self.__sampler:
+            self.__sampler.stop()
+        if self.min_wall is not None and wall < self.min_wall:
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "{}_{}_{}".format(
+            self.name, time.strftime("%Y%m%d-%H%M%S"), next(Profile.counter)))
+        summary = {"name": self.name, "mode": self.mode, "wall": wall, "cpu": cpu, "children_cpu": children,
+                   "stages": {name: {"count": stage[0], "wall": stage[1], "cpu": stage[2], "children_cpu": stage[3]}
+                              for name, stage in sorted(self.stages.items(), key=lambda item: -item[1][1])},
+                   "slow_queries": self.slow_queries}
+        with open(path + ".json", "w") as f:
+            json.dump(summary, f, indent=2)
+        if self.__cprofile:
+            self.__cprofile.dump_stats(path + ".prof")
+        if self.__sampler:
+            self.__sampler.write(path + ".folded")
+        return path + ".json"
+
+
+class NullProfile(Profile):
+    # used when profiling is off, does nothing
+
+    def __init__(self):
+        Profile.__init__(self, None, None, None)
+        self.__stage = contextlib.nullcontext()
+
+    def start(self):
+        return self
+
+    def stage(self, name: str):
+        return self.__stage
+
+    def query(self, c: sqlite3.Cursor, sql: str, params, wall: float):
+        pass
+
+    def finish(self) -> str:
+        return None
+
+
+NULL_PROFILE = NullProfile()
+
+
+class Profiler:
+    # creates the profiles of index jobs and searches. only sample_percent of the runs are profiled so that profiling
+    # can stay on in production. a mode given on the command line wins over the settings.
+
+    def __init__(self, app_data_dir: str, mode: str = None, sample_percent=100, slow_query_ms=100):
+        self.directory = os.path.join(app_data_dir, "profiles")
+        self.mode = None
+        self.sample_percent = sample_percent
+        self.slow_query_ms = slow_query_ms
+        self.forced = mode is not None
+        if mode:
+            if mode not in MODES:
+                raise ValueError("Unknown profile mode {}, expected one of {}".format(mode, ", ".join(MODES)))
+            self.mode = mode
+
+    def set_settings(self, mode: str = None, sample_percent: int = None, slow_query_ms: int = None):
+        if not self.forced:
+            self.mode = mode if mode in MODES else None
+            if sample_percent is not None:
+                self.sample_percent = sample_percent
+        if slow_query_ms is not None:
+            self.slow_query_ms = slow_query_ms
+
+    def create(self, name: str, min_wall: float = None) -> Profile:
+        if not self.mode or random.uniform(0, 100) >= self.sample_percent:
+            return NULL_PROFILE
+        return Profile(name, self.mode, self.directory, self.slow_query_ms, min_wall)
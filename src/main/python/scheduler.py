@@ -0,0 +1,103 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import List
+
+import api_interface
+
+
+class IndexScheduler(api_interface.IndexScheduler):
+    # runs queued index jobs by priority with a limited number of parallel jobs. jobs are paused while the user
+    # is searching.
+
+    def __init__(self, max_workers=1, max_memory_mb=None, nice=None, search_pause=5):
+        self.max_workers = max_workers
+        self.max_memory_mb = max_memory_mb
+        self.nice = nice
+        self.search_pause = search_pause
+
+        self.__mutex = threading.Lock()
+        self.__queue = []  # heap of (-priority, seq, job)
+        self.__counter = itertools.count()
+        self.__running = []  # type: List[api_interface.IndexJob]
+        self.__interactive_until = 0
+        self.__dispatcher = None  # type: threading.Thread
+
+    def set_limits(self, max_workers=None, max_memory_mb=None, nice=None, search_pause=None):
+        with self.__mutex:
+            if max_workers:
+                self.max_workers = max_workers
+            if max_memory_mb is not None:
+                self.max_memory_mb = max_memory_mb
+            if nice is not None:
+                self.nice = nice
+            if search_pause is not None:
+                self.search_pause = search_pause
+            # the running jobs get the new limits with their next file
+            for job in self.__running:
+                job.set_resource_limits(self.nice, self.__job_memory_mb(), self.throttle)
+        self.__dispatch()
+
+    def submit(self, job: api_interface.IndexJob, priority=0):
+        with self.__mutex:
+            heapq.heappush(self.__queue, (-priority, next(self.__counter), job))
+            if self.__dispatcher is None or not self.__dispatcher.is_alive():
+                self.__dispatcher = threading.Thread(target=self.__run, args=())
+                self.__dispatcher.daemon = True
+                self.__dispatcher.start()
+        self.__dispatch()
+
+    def cancel(self, job: api_interface.IndexJob):
+        with self.__mutex:
+            self.__queue = [entry for entry in self.__queue if entry[2] is not job]
+            heapq.heapify(self.__queue)
+            if job in self.__running:
+                job.stop()
+
+    def get_jobs(self) -> List[api_interface.IndexJob]:
+        with self.__mutex:
+            return list(self.__running) + [entry[2] for entry in sorted(self.__queue)]
+
+    def get_running_jobs(self) -> List[api_interface.IndexJob]:
+        with self.__mutex:
+            return list(self.__running)
+
+    def is_idle(self) -> bool:
+        with self.__mutex:
+            return not self.__running and not self.__queue
+
+    def notify_interactive(self):
+        self.__interactive_until = time.time() + self.search_pause
+
+    def throttle(self):
+        # called by the jobs between files and pages
+        while time.time() < self.__interactive_until:
+            time.sleep(0.1)
+
+    def __dispatch(self):
+        with self.__mutex:
+            self.__running = [job for job in self.__running if not job.is_finished()]
+            max_memory_mb = self.__job_memory_mb()
+            # a job waits while another job of its directory is running, e.g. a cancelled one finishing its page
+            waiting = []
+            while self.__queue and len(self.__running) < self.max_workers:
+                entry = heapq.heappop(self.__queue)
+                job = entry[2]
+                if any(running.get_path() == job.get_path() for running in self.__running):
+                    waiting.append(entry)
+                    continue
+                job.set_resource_limits(self.nice, max_memory_mb, self.throttle)
+                job.start()
+                self.__running.append(job)
+            for entry in waiting:
+                heapq.heappush(self.__queue, entry)
+
+    def __job_memory_mb(self):
+        # divides the memory budget between the jobs which may run at the same time
+        return self.max_memory_mb // self.max_workers if self.max_memory_mb else None
+
+    def __run(self):
+        while not self.is_idle():
+            self.__dispatch()
+            time.sleep(0.5)
@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+# the modules of the app are not installed, they are run from the source tree
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "main", "python"))
+
+import api
+import fakes
+
+
+@pytest.fixture
+def fake_ocr_engine(monkeypatch):
+    # replaces cv2, tesseract and poppler. forked worker processes inherit the fakes.
+    monkeypatch.setattr(multiprocessing, "Process", multiprocessing.get_context("fork").Process)
+    monkeypatch.setattr(api, "load_gray", fakes.fake_load_gray)
+    monkeypatch.setattr(api, "page_fingerprint", fakes.fake_fingerprint)
+    monkeypatch.setattr(api, "ocr_image", fakes.fake_ocr)
+    monkeypatch.setattr(api, "pdf_to_images", fakes.fake_pdf_to_images)
+    # pages are equal if their texts are
+    monkeypatch.setattr(api, "same_page", lambda gray, other: gray == other)
+    monkeypatch.setattr(api, "encode_page", lambda gray: gray)
+    monkeypatch.setattr(api, "decode_page", lambda data: data)
+    return monkeypatch
+
+
+@pytest.fixture
+def receipts(tmp_path):
+    # an app with an empty directory to index
+    directory = tmp_path / "receipts"
+    directory.mkdir()
+    app_data = tmp_path / "app_data"
+    app_data.mkdir()
+    app = api.WheresTheFckReceipt(str(app_data), api.DbFactory(str(app_data)), api.IndexJobFactory())
+    return app, str(directory).replace("\\", "/")
@@ -0,0 +1,39 @@
+import hashlib
+
+
+def fake_load_gray(path):
+    # the text of a fake image file stands in for its pixels
+    with open(path) as f:
+        return f.read()
+
+
+def fake_fingerprint(gray):
+    return 0.5, hashlib.sha256(gray.encode("utf-8")).hexdigest()
+
+
+def fake_ocr(path, img_gray=None, profile=None):
+    if img_gray is None:
+        img_gray = fake_load_gray(path)
+    return [(word, 10 * i, 20, 30, 40) for i, word in enumerate(img_gray.split())], 90.0
+
+
+class FakeRendering:
+    # a rendered pdf page, the preview file records the dpi it was rendered with
+
+    def __init__(self, text, dpi):
+        self.text = text
+        self.dpi = dpi
+
+    def save(self, path, format):
+        with open(path, "w") as f:
+            f.write("{}\n{}".format(self.dpi, self.text))
+
+
+def fake_pdf_to_images(path, app_data_path, poppler_path=None, max_memory_mb=None, dpi=300, profile=None):
+    # the pages of a fake pdf are separated by form feeds
+    import api
+    with open(path) as f:
+        texts = f.read().split("\f")
+    for page, text in enumerate(texts, 1):
+        img_path = app_data_path + "/" + hashlib.md5(path.encode('utf-8')).hexdigest() + "_page" + str(page) + ".jpg"
+        yield api.Page(img_path, path, page, fake_fingerprint(text), dpi, text, FakeRendering(text, dpi))
@@ -0,0 +1,493 @@
+import os
+import random
+import sqlite3
+import threading
+
+import pytest
+
+import api
+import fakes
+import scheduler
+
+
+def index(app: api.WheresTheFckReceipt, directory):
+    job = app.add_directory(directory)
+    events = []
+    job.add_listener(events.append)
+    job.run()
+    assert events[-1].kind == api.IndexEvent.FINISHED and events[-1].detail == api.IndexEvent.DONE
+    return events
+
+
+def previews(app: api.WheresTheFckReceipt):
+    # the dpi of the stored words and of the preview file of every pdf page
+    rows = app.db.execute("select path, dpi from images where document_id is not null").fetchall()
+    result = {}
+    for path, dpi in rows:
+        with open(path) as f:
+            result[path] = (dpi, int(f.readline()))
+    return result
+
+
+def test_previews_match_words_after_reindex(receipts, fake_ocr_engine):
+    app, directory = receipts
+    with open(directory + "/doc.pdf", "w") as f:
+        f.write("total 1 eur\ftotal 2 eur")
+    app.set_settings({"pdf_low_dpi": "150"})
+    index(app, directory)
+    assert sorted(previews(app).values()) == [(150, 150), (150, 150)]
+
+    app.set_settings({"pdf_low_dpi": "100"})
+    app.remove_directory(directory)
+    index(app, directory)
+    assert sorted(previews(app).values()) == [(100, 100), (100, 100)]
+
+
+def test_missing_preview_is_processed_again(receipts, fake_ocr_engine):
+    app, directory = receipts
+    with open(directory + "/doc.pdf", "w") as f:
+        f.write("total 1 eur\ftotal 2 eur")
+    app.set_settings({"pdf_low_dpi": "150"})
+    index(app, directory)
+    path = sorted(previews(app))[0]
+    os.remove(path)
+    app.set_settings({"pdf_low_dpi": "100"})
+    events = index(app, directory)
+    done = [event.detail for event in events if event.kind == api.IndexEvent.PAGE_DONE]
+    assert sorted(done) == [api.IndexEvent.OCR, api.IndexEvent.UNCHANGED]
+    assert previews(app)[path] == (100, 100)
+
+
+def test_remove_directory_deletes_previews(receipts, fake_ocr_engine):
+    app, directory = receipts
+    with open(directory + "/doc.pdf", "w") as f:
+        f.write("total 1 eur")
+    with open(directory + "/receipt.png", "w") as f:
+        f.write("total 2 eur")
+    index(app, directory)
+    paths = list(previews(app))
+    assert len(paths) == 1 and os.path.exists(paths[0])
+    app.remove_directory(directory)
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(directory + "/receipt.png")
+
+
+def test_page_hashes_find_near_duplicates():
+    rng = random.Random(1)
+    db = sqlite3.connect(":memory:")
+    db.execute("create table images (id integer primary key, phash text)")
+    db.execute("create table pages (image_id integer primary key)")
+    page_hashes = api.PageHashes(db.cursor())
+    values = [rng.getrandbits(api.PHASH_BITS) for _ in range(200)]
+    # near copies of some of the hashes
+    for value in values[:50]:
+        for bit in rng.sample(range(api.PHASH_BITS), rng.randint(1, 12)):
+            value ^= 1 << bit
+        values.append(value)
+    for image_id, value in enumerate(values):
+        page_hashes.add("%064x" % value, image_id)
+    for max_distance in (0, 3, 8, 12, 40):
+        for image_id, value in enumerate(values[:60]):
+            assert page_hashes.find("%064x" % value, max_distance) == [(0, image_id)]
+            # a hash which is not indexed is compared with all others
+            near = value ^ 1
+            expected = sorted((bin(near ^ other).count("1"), other_id) for other_id, other in enumerate(values)
+                              if bin(near ^ other).count("1") <= max_distance)
+            assert page_hashes.find("%064x" % near, max_distance) == (expected if max_distance > 0 else [])
+
+
+def test_near_duplicate_is_confirmed_by_pixels(receipts, fake_ocr_engine):
+    app, directory = receipts
+    phashes = {"total 1 eur": "0" * 64, "total 1 eur.": "0" * 63 + "1", "total 2 eur": "0" * 62 + "11"}
+    fake_ocr_engine.setattr(api, "page_fingerprint", lambda gray: (0.5, phashes[gray]))
+    # pages are equal for the pixel check if they only differ by a dot
+    fake_ocr_engine.setattr(api, "same_page", lambda gray, other: gray.rstrip(".") == other.rstrip("."))
+    app.set_settings({"duplicate_page_distance": "4"})
+    for i, text in enumerate(phashes):
+        with open(directory + "/receipt{}.png".format(i), "w") as f:
+            f.write(text)
+        events = index(app, directory)
+    # receipt1 is the near duplicate of receipt0, receipt2 is near but different
+    done = {event.path: event.detail for event in events if event.kind == api.IndexEvent.PAGE_DONE}
+    assert done[directory + "/receipt2.png"] == api.IndexEvent.OCR
+    words = app.db.execute("select images.path, pages.text from images, pages where pages.image_id = images.id").fetchall()
+    assert dict(words) == {directory + "/receipt0.png": "total\n1\neur", directory + "/receipt1.png": "total\n1\neur",
+                           directory + "/receipt2.png": "total\n2\neur"}
+
+
+def test_duplicate_distance_defaults_to_exact_matches(tmp_path):
+    db_factory = api.DbFactory(str(tmp_path))
+    db = db_factory.create()
+    assert db.execute("select value from settings where key = 'duplicate_page_distance'").fetchone()[0] == "0"
+    # a database from before schema version 11 with the old default
+    db.execute("update settings set value = '8' where key = 'duplicate_page_distance'")
+    db.execute("update settings set value = '10' where key = 'current_schema_version'")
+    db.commit()
+    db.close()
+    api.DbFactory.checked_db_paths.discard(db_factory.db_path)
+    db = db_factory.create()
+    assert db.execute("select value from settings where key = 'duplicate_page_distance'").fetchone()[0] == "0"
+    assert int(db.execute("select value from settings where key = 'current_schema_version'").fetchone()[0]) >= 11
+    db.close()
+
+
+def test_pack_words_round_trip():
+    words = [("Total", 100, 2000, 120, 40), ("12,50", 240, 2001, 100, 41), ("EUR", 360, 1999, 70, 40)]
+    text, blob = api.pack_words(words)
+    assert text == "Total\n12,50\nEUR"
+    assert blob[:1] == b"h"
+    packed = api.PackedWords(text, blob)
+    assert packed.get_box(1) == (240, 2001, 100, 41)
+    assert packed.unpack() == words
+
+
+def test_pack_words_uses_int32_for_large_steps():
+    words = [("x", 70000, -5, 1, 1), ("y", 1, 2, 3, 4)]
+    text, blob = api.pack_words(words)
+    assert blob[:1] == b"i"
+    assert api.PackedWords(text, blob).unpack() == words
+
+
+def test_pack_words_empty_page():
+    text, blob = api.pack_words([])
+    packed = api.PackedWords(text, blob)
+    assert packed.get_texts() == []
+    assert packed.unpack() == []
+
+
+def test_migration_packs_the_words_of_every_page(tmp_path):
+    db_factory = api.DbFactory(str(tmp_path))
+    db = sqlite3.connect(db_factory.db_path)
+    # the tables of schema version 8 which the migration reads
+    db.execute("create table settings (key text primary key, value text, help text, type text not null, hidden integer not null)")
+    db.execute("insert into settings (key, value, help, type, hidden) values('current_schema_version', '8', 'Current Schema Version', 'int', 1)")
+    db.execute("CREATE TABLE images ( id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE NOT NULL, ink REAL )")
+    db.execute(
+        "CREATE TABLE texts ( id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, left INTEGER  NOT NULL, top INTEGER NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL, image_id INTEGER NOT NULL, FOREIGN KEY(image_id) REFERENCES images(id) ON DELETE CASCADE )")
+    pages = {"a.png": [("total", 10, 20, 30, 40), ("1", 50, 20, 10, 40)], "b.png": [("eur", 5, 6, 7, 8)], "c.png": []}
+    for path, words in pages.items():
+        image_id = db.execute("insert into images (path) values (?)", (path,)).lastrowid
+        db.executemany("insert into texts (text, left, top, width, height, image_id) values (?, ?, ?, ?, ?, ?)",
+                       [word + (image_id,) for word in words])
+    db.commit()
+    db.close()
+
+    db = db_factory.create()
+    tables = [row[0] for row in db.execute("select name from sqlite_master where type = 'table'")]
+    assert "texts" not in tables
+    rows = db.execute("select images.path, pages.text, pages.words from images, pages where pages.image_id = images.id").fetchall()
+    # pages without words get no row
+    assert {path: api.PackedWords(text, blob).unpack() for path, text, blob in rows} == \
+        {path: words for path, words in pages.items() if words}
+    assert db.execute("PRAGMA page_size").fetchone()[0] == api.DB_PAGE_SIZE
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    db.close()
+
+
+def results(*texts):
+    return [api.Result("receipt.png", text, None, None, None, i) for i, text in enumerate(texts)]
+
+
+def test_query_cache_refines_typed_ahead_queries():
+    cache = api.QueryCache()
+    assert cache.get(1, "to", False, None) is None
+    cache.put(1, "to", False, None, results("total", "Tomato", "stop"))
+    assert [result.text for result in cache.get(1, "tot", False, None)] == ["total"]
+    assert [result.text for result in cache.get(1, "tom", False, None)] == ["Tomato"]
+    # the refined results are cached themselves, and limited
+    assert [result.text for result in cache.get(1, "to", False, 2)] == ["total", "Tomato"]
+    # wildcards of like are not refined
+    assert cache.get(1, "t_t", False, None) is None
+    assert cache.get(1, "to", True, None) is None
+
+
+def test_query_cache_does_not_refine_truncated_results():
+    cache = api.QueryCache()
+    # the search stopped after 2 results, so "tot" may have matches beyond them
+    cache.put(1, "to", False, 2, results("stop", "tomato"))
+    assert cache.get(1, "tot", False, 2) is None
+    assert cache.get(1, "tot", False, None) is None
+    # fewer results than the limit are complete
+    cache.put(1, "e", False, 5, results("eur", "ten"))
+    assert [result.text for result in cache.get(1, "eu", False, 5)] == ["eur"]
+
+
+def test_query_cache_is_cleared_with_a_new_generation(receipts, fake_ocr_engine):
+    app, directory = receipts
+    with open(directory + "/receipt0.png", "w") as f:
+        f.write("total 1 eur")
+    index(app, directory)
+    assert [result.get_text() for result in app.search("tot")] == ["total"]
+    with open(directory + "/receipt1.png", "w") as f:
+        f.write("total 2 eur")
+    generation = app.db_factory.get_generation()
+    index(app, directory)
+    assert app.db_factory.get_generation() > generation
+    assert [result.get_text() for result in app.search("tot")] == ["total", "total"]
+    assert [result.get_text() for result in app.search("tota")] == ["total", "total"]
+
+
+def test_files_not_indexed_yet_come_first(receipts, fake_ocr_engine):
+    app, directory = receipts
+    with open(directory + "/indexed.png", "w") as f:
+        f.write("total")
+    index(app, directory)
+    for name, text in (("large.png", "total 1 eur"), ("small.png", "eur")):
+        with open(directory + "/" + name, "w") as f:
+            f.write(text)
+    files = sorted(api.find_files(directory))
+    assert api.prioritize_files(app.db.cursor(), files) == \
+        [directory + "/small.png", directory + "/large.png", directory + "/indexed.png"]
+
+
+def test_job_stops_between_pages(receipts, fake_ocr_engine):
+    app, directory = receipts
+    with open(directory + "/doc.pdf", "w") as f:
+        f.write("total 1 eur\ftotal 2 eur\ftotal 3 eur")
+    job = app.add_directory(directory)
+    events = []
+
+    def stop_after_first_page(event):
+        events.append(event)
+        if event.kind == api.IndexEvent.PAGE_DONE:
+            job.stop()
+
+    job.add_listener(stop_after_first_page)
+    job.run()
+    assert events[-1].detail == api.IndexEvent.STOPPED
+    assert len([event for event in events if event.kind == api.IndexEvent.PAGE_DONE]) == 1
+    # the page which was done is kept, the next run continues with the others
+    assert len(previews(app)) == 1
+    done = [event.detail for event in index(app, directory) if event.kind == api.IndexEvent.PAGE_DONE]
+    assert done == [api.IndexEvent.UNCHANGED, api.IndexEvent.OCR, api.IndexEvent.OCR]
+
+
+def test_iter_events_ends_after_the_events_were_drained(receipts, fake_ocr_engine):
+    app, directory = receipts
+    with open(directory + "/receipt.png", "w") as f:
+        f.write("total 1 eur")
+    job = app.add_directory(directory)
+    job.run()
+    assert job.get_events()[-1].kind == api.IndexEvent.FINISHED
+    # without a timeout this waited forever for the finished event which was drained already
+    iterated = []
+    thread = threading.Thread(target=lambda: iterated.extend(job.iter_events()), daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert iterated == []
+
+
+def test_event_messages_show_relative_paths(receipts, fake_ocr_engine):
+    app, directory = receipts
+    os.mkdir(directory + "/2020")
+    with open(directory + "/2020/receipt.png", "w") as f:
+        f.write("total 1 eur")
+    messages = [str(event) for event in index(app, directory)]
+    assert "File 1 of 1: Analyzing 2020/receipt.png." in messages
+    assert "Extracted text from 2020/receipt.png." in messages
+    assert "Scanning files in {}".format(directory) in messages
+
+
+def test_same_form_pages_are_not_reused(receipts, fake_ocr_engine):
+    app, directory = receipts
+    # receipts of one vendor form get the same hash, also with the default distance of 0
+    fake_ocr_engine.setattr(api, "page_fingerprint", lambda gray: (0.5, "0" * 64))
+    for i, text in enumerate(["total 1 eur", "total 2 eur", "total 1 eur"]):
+        with open(directory + "/receipt{}.png".format(i), "w") as f:
+            f.write(text)
+        index(app, directory)
+    with open(directory + "/scan.pdf", "w") as f:
+        f.write("total 3 eur\ftotal 4 eur\ftotal 3 eur")
+    events = index(app, directory)
+    done = {event.path: event.detail for event in events if event.kind == api.IndexEvent.PAGE_DONE}
+    assert [detail for path, detail in sorted(done.items()) if path.endswith(".jpg")].count(api.IndexEvent.DUPLICATE) == 1
+    words = dict(app.db.execute("select images.path, pages.text from images, pages where pages.image_id = images.id"))
+    assert words[directory + "/receipt1.png"] == "total\n2\neur"
+    assert words[directory + "/receipt2.png"] == "total\n1\neur"
+    assert sorted(text for path, text in words.items() if path.endswith(".jpg")) == \
+        ["total\n3\neur", "total\n3\neur", "total\n4\neur"]
+
+
+def draw_invoice(cv2, np, number, total):
+    # an a4 page at 150 dpi of a vendor form
+    page = np.full((1754, 1240), 255, np.uint8)
+    cv2.rectangle(page, (80, 80), (1160, 300), 0, 3)
+    cv2.putText(page, "ACME Office Supplies GmbH", (120, 200), cv2.FONT_HERSHEY_SIMPLEX, 1.6, 0, 3)
+    for line in range(12):
+        y = 420 + line * 70
+        cv2.putText(page, "Item {:02d}  Paper A4 500 sheets".format(line), (120, y), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2)
+        cv2.putText(page, "4.99", (1000, y), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2)
+    cv2.putText(page, "Invoice no. {}".format(number), (120, 1400), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 0, 1)
+    cv2.putText(page, "Total {}".format(total), (120, 1500), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 0, 1)
+    return page
+
+
+def test_same_page_detects_other_amounts():
+    np = pytest.importorskip("numpy")
+    cv2 = pytest.importorskip("cv2")
+    page = draw_invoice(cv2, np, "2024-0815", "59.88 EUR")
+    # one other digit each
+    assert not api.same_page(page, draw_invoice(cv2, np, "2024-0816", "59.89 EUR"))
+    noisy = np.clip(page.astype(np.int16) + np.random.default_rng(1).integers(-20, 20, page.shape), 0, 255)
+    assert api.same_page(page, noisy.astype(np.uint8))
+    jpeg = cv2.imdecode(cv2.imencode(".jpg", page, [cv2.IMWRITE_JPEG_QUALITY, 50])[1], cv2.IMREAD_GRAYSCALE)
+    assert api.same_page(page, jpeg)
+    assert api.same_page(page, api.decode_page(api.encode_page(page)))
+
+
+def test_same_form_receipts_with_other_amounts_are_ocred(receipts, fake_ocr_engine):
+    np = pytest.importorskip("numpy")
+    cv2 = pytest.importorskip("cv2")
+    app, directory = receipts
+    # the real fingerprint and pixel check, only the ocr is fake
+    fake_ocr_engine.undo()
+    ocred = []
+    fake_ocr_engine.setattr(api, "ocr_image", lambda path, img_gray=None, profile=None:
+                            (ocred.append(path) or [(os.path.basename(path), 1, 2, 3, 4)], 90.0))
+    a = draw_invoice(cv2, np, "2024-0815", "59.88 EUR")
+    b = draw_invoice(cv2, np, "2024-0816", "64.87 EUR")
+    assert api.page_fingerprint(a)[1] == api.page_fingerprint(b)[1]
+    cv2.imwrite(directory + "/a.png", a)
+    cv2.imwrite(directory + "/b.png", b)
+    cv2.imwrite(directory + "/copy_of_a.png", a)
+    index(app, directory)
+    words = dict(app.db.execute("select images.path, pages.text from images, pages where pages.image_id = images.id"))
+    assert words[directory + "/b.png"] == "b.png"
+    # the real copy is reused from whichever of both was indexed first
+    assert words[directory + "/a.png"] == words[directory + "/copy_of_a.png"]
+    assert len(ocred) == 2
+
+
+def faint_fingerprint(gray):
+    # pages starting with "faint" have 10 ink pixels per 10000
+    return 0.001 if gray.startswith("faint") else 0.5, fakes.fake_fingerprint(gray)[1]
+
+
+def test_blank_pages_are_checked_again_with_a_lower_threshold(receipts, fake_ocr_engine):
+    app, directory = receipts
+    fake_ocr_engine.setattr(api, "page_fingerprint", faint_fingerprint)
+    with open(directory + "/receipt.png", "w") as f:
+        f.write("faint total 1 eur")
+    with open(directory + "/empty.png", "w") as f:
+        f.write("")
+
+    def details():
+        return {os.path.basename(event.path): event.detail for event in index(app, directory)
+                if event.kind == api.IndexEvent.PAGE_DONE}
+
+    app.set_settings({"blank_page_threshold": "20"})
+    assert details()["receipt.png"] == api.IndexEvent.BLANK
+    assert details() == {"receipt.png": api.IndexEvent.UNCHANGED, "empty.png": api.IndexEvent.UNCHANGED}
+    app.set_settings({"blank_page_threshold": "3"})
+    # the page without any words was ocred and is not checked again
+    assert details() == {"receipt.png": api.IndexEvent.OCR, "empty.png": api.IndexEvent.UNCHANGED}
+    assert details()["receipt.png"] == api.IndexEvent.UNCHANGED
+    words = dict(app.db.execute("select images.path, pages.text from images, pages where pages.image_id = images.id"))
+    assert words == {directory + "/receipt.png": "faint\ntotal\n1\neur"}
+
+
+def test_migration_measures_ink_again(tmp_path):
+    db_factory = api.DbFactory(str(tmp_path))
+    db = db_factory.create()
+    assert db.execute("select value from settings where key = 'blank_page_threshold'").fetchone()[0] == "3"
+    db.execute("insert into directories (path) values ('/receipts')")
+    db.execute("insert into images (path, directory_id, ink) values ('/receipts/a.png', 1, 0.0001)")
+    db.execute("update settings set value = '20' where key = 'blank_page_threshold'")
+    db.execute("update settings set value = '11' where key = 'current_schema_version'")
+    db.commit()
+    db.close()
+    api.DbFactory.checked_db_paths.discard(db_factory.db_path)
+    db = db_factory.create()
+    assert db.execute("select value from settings where key = 'blank_page_threshold'").fetchone()[0] == "3"
+    assert db.execute("select ink from images").fetchone()[0] is None
+    db.close()
+
+
+def draw_receipt(cv2, np, lines, paper, ink, noise=3.0):
+    page = np.random.default_rng(1).normal(paper, noise, (1754, 1240))
+    mask = np.zeros(page.shape, np.uint8)
+    for i, line in enumerate(lines):
+        cv2.putText(mask, line, (120, 300 + i * 70), cv2.FONT_HERSHEY_SIMPLEX, 1, 255, 2)
+    page[mask > 0] = ink
+    return np.clip(page, 0, 255).astype(np.uint8)
+
+
+def test_ink_is_measured_against_the_paper():
+    np = pytest.importorskip("numpy")
+    cv2 = pytest.importorskip("cv2")
+    threshold = 3
+    faded_thermal = draw_receipt(cv2, np, ["ACME", "Total 12.00", "Thank you"], 235, 150)
+    assert not api.is_blank(api.page_fingerprint(faded_thermal), threshold)
+    one_line = draw_receipt(cv2, np, ["Total: 1,234.00 EUR"], 255, 0, 0)
+    assert not api.is_blank(api.page_fingerprint(one_line), threshold)
+    for noise in (3, 6, 10):
+        assert api.is_blank(api.page_fingerprint(draw_receipt(cv2, np, [], 235, 0, noise)), threshold)
+
+
+@pytest.mark.parametrize("platform", ["linux", "darwin"])
+def test_failing_nice_does_not_fail_the_job(receipts, fake_ocr_engine, platform):
+    app, directory = receipts
+    with open(directory + "/receipt.png", "w") as f:
+        f.write("total 1 eur")
+    calls = []
+
+    def setpriority(which, who, priority):
+        calls.append(priority)
+        raise OSError(3, "No such process")
+
+    fake_ocr_engine.setattr(api.sys, "platform", platform)
+    fake_ocr_engine.setattr(api.os, "setpriority", setpriority, raising=False)
+    job = app.add_directory(directory)
+    job.set_resource_limits(nice=10)
+    events = []
+    job.add_listener(events.append)
+    job.run()
+    assert events[-1].detail == api.IndexEvent.DONE
+    assert calls == ([10] if platform == "linux" else [])
+
+
+def test_set_settings_reloads_the_settings_cache(receipts):
+    app, directory = receipts
+    assert app.get_setting("pdf_dpi") == 300
+    changes = []
+    app.add_settings_listener(changes.append)
+    app.set_settings({"pdf_dpi": "200", "min_confidence": app.get_settings()["min_confidence"][0]})
+    assert app.get_setting("pdf_dpi") == 200
+    assert app.get_settings()["pdf_dpi"][0] == "200"
+    # only changed values are announced
+    assert changes == [{"pdf_dpi": 200}]
+    app.set_settings({"pdf_dpi": "200"})
+    assert changes == [{"pdf_dpi": 200}]
+
+
+def test_changed_settings_reach_the_running_job(receipts, fake_ocr_engine):
+    app, directory = receipts
+    app = api.WheresTheFckReceipt(app.app_data_dir, app.db_factory, api.IndexJobFactory(), scheduler.IndexScheduler())
+    for i in range(2):
+        with open(directory + "/receipt{}.png".format(i), "w") as f:
+            f.write("total {} eur".format(i))
+    priorities = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_ocr(path, img_gray=None, profile=None):
+        started.set()
+        release.wait(10)
+        return fakes.fake_ocr(path, img_gray, profile)
+
+    fake_ocr_engine.setattr(api, "ocr_image", blocking_ocr)
+    fake_ocr_engine.setattr(api.sys, "platform", "linux")
+    fake_ocr_engine.setattr(api.os, "setpriority", lambda which, who, priority: priorities.append(priority),
+                            raising=False)
+    job = app.add_directory(directory)
+    app.get_scheduler().submit(job)
+    assert started.wait(10)
+
+    app.set_settings({"index_nice": "15", "index_max_memory_mb": "512", "pdf_dpi": "200"})
+    assert (job.nice, job.max_memory_mb, job.dpi) == (15, 512, 200)
+    release.set()
+    events = list(job.iter_events(10))
+    assert events[-1].kind == api.IndexEvent.FINISHED and events[-1].detail == api.IndexEvent.DONE
+    # the new priority is set before the next file
+    assert priorities == [10, 15]
@@ -0,0 +1,217 @@
+import multiprocessing
+import time
+from multiprocessing.connection import Client
+
+import pytest
+
+import api
+import fakes
+import distributed
+from distributed import TaskQueue
+
+
+@pytest.fixture
+def task_queue(tmp_path):
+    queue = TaskQueue(str(tmp_path / "queue.sqlite3"), lease_seconds=60, max_attempts=2)
+    queue.open()
+    yield queue
+    queue.close()
+
+
+def expire(queue: TaskQueue):
+    queue.db.execute("update tasks set lease_expires = ? where state = ?", (time.time() - 1, TaskQueue.LEASED))
+    queue.db.commit()
+
+
+def test_lease_is_exclusive(task_queue):
+    task_queue.enqueue(["a.png", "b.png"])
+    first = task_queue.lease("w1", 1)
+    second = task_queue.lease("w2", 5)
+    assert [task[1] for task in first] == ["a.png"]
+    assert [task[1] for task in second] == ["b.png"]
+    assert task_queue.lease("w3", 5) == []
+
+
+def test_expired_lease_is_retried(task_queue):
+    task_queue.enqueue(["a.png"])
+    task_id = task_queue.lease("w1")[0][0]
+    expire(task_queue)
+    assert task_queue.counts()[TaskQueue.PENDING] == 1
+    assert task_queue.lease("w2") == [(task_id, "a.png")]
+    # the result of the worker which lost the lease is dropped
+    assert not task_queue.complete("w1", task_id)
+    assert task_queue.complete("w2", task_id)
+    assert task_queue.counts()[TaskQueue.DONE] == 1
+
+
+def test_renew_keeps_lease(task_queue):
+    task_queue.enqueue(["a.png"])
+    task_id = task_queue.lease("w1")[0][0]
+    expire(task_queue)
+    task_queue.renew("w1", [task_id])
+    assert task_queue.counts()[TaskQueue.LEASED] == 1
+
+
+def test_failed_task_is_retried(task_queue):
+    task_queue.enqueue(["a.png"])
+    task_id = task_queue.lease("w1")[0][0]
+    task_queue.fail("w1", task_id, "error")
+    assert task_queue.counts()[TaskQueue.PENDING] == 1
+    assert task_queue.lease("w2")[0][0] == task_id
+
+
+def test_task_fails_after_max_attempts(task_queue):
+    task_queue.enqueue(["a.png", "b.png"])
+    for attempt in range(2):
+        tasks = task_queue.lease("w1", 2)
+        task_queue.fail("w1", tasks[0][0], "error")
+        expire(task_queue)
+    counts = task_queue.counts()
+    assert counts[TaskQueue.FAILED] == 2
+    assert counts[TaskQueue.PENDING] == 0
+    assert task_queue.lease("w1") == []
+
+
+def test_closed_queue_leases_nothing(task_queue):
+    task_queue.enqueue(["a.png"])
+    task_id = task_queue.lease("w1")[0][0]
+    task_queue.close()
+    task_queue.renew("w1", [task_id])
+    assert task_queue.lease("w2") == []
+
+
+def test_coordinator_sends_settings_and_answers_renew_after_shutdown(tmp_path):
+    directory = tmp_path / "receipts"
+    directory.mkdir()
+    (directory / "receipt.png").write_text("total 1 eur")
+    app_data = tmp_path / "app_data"
+    app_data.mkdir()
+    coordinator = distributed.Coordinator(str(directory).replace("\\", "/"), api.DbFactory(str(app_data)),
+                                          str(app_data), authkey=b"key")
+    coordinator.start()
+    while coordinator.get_address() is None:
+        time.sleep(0.05)
+    conn = Client(coordinator.get_address(), authkey=b"key")
+    conn.send(("hello", "w1"))
+    conn.recv()
+    # settings changed after the hello are sent with the next lease
+    coordinator.set_settings({"pdf_dpi": 150})
+    conn.send(("lease", "w1", 1))
+    tasks, config = conn.recv()
+    assert config["dpi"] == 150
+    task_id = tasks[0][0]
+
+    coordinator.stop()
+    for event in coordinator.iter_events(10):
+        pass
+    assert coordinator.is_finished()
+    # the queue is closed, the worker is told to stop instead of the serve thread failing
+    conn.send(("renew", "w1", [task_id]))
+    assert conn.recv() is None
+    conn.close()
+
+
+def test_local_paths_of_a_worker_win():
+    worker = distributed.Worker(("localhost", 0), b"key", poppler_path="/opt/poppler")
+    config = {"app_data_path": "/data", "poppler_path": "/usr/bin", "tesseract_exe": None, "blank_threshold": 3,
+              "duplicate_distance": 0, "dpi": 300, "low_dpi": None, "min_confidence": None, "lease_seconds": 60}
+    worker.configure(config)
+    worker.configure(dict(config, dpi=200, blank_threshold=5))
+    assert (worker.app_data_path, worker.poppler_path) == ("/data", "/opt/poppler")
+    assert (worker.dpi, worker.blank_threshold) == (200, 5)
+
+
+def fake_slow_ocr(path, img_gray=None, profile=None):
+    time.sleep(1.5)
+    return fakes.fake_ocr(path, img_gray, profile)
+
+
+needs_fork = pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(),
+                                reason="the workers must inherit the fake ocr")
+
+
+@needs_fork
+def test_coordinator_with_local_workers(tmp_path, fake_ocr_engine):
+    directory = tmp_path / "receipts"
+    (directory / "sub").mkdir(parents=True)
+    texts = {}
+    for i in range(6):
+        path = directory / ("sub" if i % 2 else "") / "receipt{}.png".format(i)
+        texts[str(path).replace("\\", "/")] = "total {} eur".format(i)
+        path.write_text(texts[str(path).replace("\\", "/")])
+    app_data = tmp_path / "app_data"
+    app_data.mkdir()
+    db_factory = api.DbFactory(str(app_data))
+
+    coordinator = distributed.Coordinator(str(directory).replace("\\", "/"), db_factory, str(app_data),
+                                          num_local_workers=2, lease_seconds=5)
+    coordinator.run()
+
+    assert coordinator.is_finished()
+    events = coordinator.get_events()
+    assert events[-1].kind == api.IndexEvent.FINISHED and events[-1].detail == api.IndexEvent.DONE
+    db = db_factory.create()
+    rows = db.execute("select images.path, pages.text, pages.words from images, pages where pages.image_id = images.id").fetchall()
+    db.close()
+    assert sorted(row[0] for row in rows) == sorted(texts)
+    for path, text, blob in rows:
+        words = api.PackedWords(text, blob).unpack()
+        assert [word[0] for word in words] == texts[path].split()
+        assert words[1] == ("{}".format(texts[path].split()[1]), 10, 20, 30, 40)
+
+
+@needs_fork
+def test_worker_renews_lease_while_processing(tmp_path, fake_ocr_engine):
+    fake_ocr_engine.setattr(api, "ocr_image", fake_slow_ocr)
+    directory = tmp_path / "receipts"
+    directory.mkdir()
+    (directory / "receipt.png").write_text("total 1 eur")
+    app_data = tmp_path / "app_data"
+    app_data.mkdir()
+
+    coordinator = distributed.Coordinator(str(directory).replace("\\", "/"), api.DbFactory(str(app_data)),
+                                          str(app_data), num_local_workers=1, lease_seconds=1, max_attempts=1)
+    coordinator.run()
+
+    # the ocr takes longer than the lease, the task would have failed without the heartbeat
+    coordinator.queue.open()
+    counts = coordinator.queue.counts()
+    coordinator.queue.close()
+    assert counts[TaskQueue.DONE] == 1
+    assert counts[TaskQueue.FAILED] == 0
+
+
+def test_worker_does_not_reuse_same_form_pages(tmp_path, fake_ocr_engine):
+    fake_ocr_engine.setattr(api, "page_fingerprint", lambda gray: (0.5, "0" * 64))
+    (tmp_path / "scan.pdf").write_text("total 3 eur\ftotal 4 eur\ftotal 3 eur")
+    worker = distributed.Worker(("localhost", 0), b"key", str(tmp_path))
+    worker.duplicate_distance = 0
+    pages = worker.process(str(tmp_path / "scan.pdf"))
+    assert [[word[0] for word in page.words] for page in pages] == \
+        [["total", "3", "eur"], ["total", "4", "eur"], ["total", "3", "eur"]]
+    assert all(page.image is None and page.preview is None for page in pages)
+
+
+@needs_fork
+def test_coordinator_checks_blank_pages_again(tmp_path, fake_ocr_engine):
+    fake_ocr_engine.setattr(api, "page_fingerprint",
+                            lambda gray: (0.001 if gray.startswith("faint") else 0.5, fakes.fake_fingerprint(gray)[1]))
+    directory = tmp_path / "receipts"
+    directory.mkdir()
+    (directory / "receipt.png").write_text("faint total 1 eur")
+    app_data = tmp_path / "app_data"
+    app_data.mkdir()
+    db_factory = api.DbFactory(str(app_data))
+
+    def words():
+        db = db_factory.create()
+        rows = db.execute("select pages.text from pages").fetchall()
+        db.close()
+        return rows
+
+    for blank_threshold in (20, 20, 3):
+        distributed.Coordinator(str(directory).replace("\\", "/"), db_factory, str(app_data),
+                                blank_threshold=blank_threshold, num_local_workers=1).run()
+        if blank_threshold == 20:
+            assert words() == []
+    assert words() == [("faint\ntotal\n1\neur",)]
@@ -0,0 +1,101 @@
+import pytest
+
+import scheduler
+
+
+class FakeJob:
+    # an index job which runs until the test finishes it
+
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path or name
+        self.started = []
+        self.limits = None
+        self.stopped = False
+        self.finished = False
+
+    def get_path(self):
+        return self.path
+
+    def set_resource_limits(self, nice=None, max_memory_mb=None, throttle=None):
+        self.limits = (nice, max_memory_mb)
+
+    def start(self):
+        self.started.append(self.name)
+
+    def stop(self):
+        self.stopped = True
+
+    def is_finished(self):
+        return self.finished
+
+
+@pytest.fixture
+def index_scheduler():
+    # the dispatcher thread is not needed, set_limits dispatches the queued jobs right away
+    return scheduler.IndexScheduler(max_workers=1, search_pause=0)
+
+
+def names(jobs):
+    return [job.name for job in jobs]
+
+
+def test_jobs_run_by_priority(index_scheduler):
+    first = FakeJob("first")
+    index_scheduler.submit(first)
+    index_scheduler.submit(FakeJob("low"), -1)
+    index_scheduler.submit(FakeJob("high"), 5)
+    index_scheduler.submit(FakeJob("default"))
+    assert names(index_scheduler.get_jobs()) == ["first", "high", "default", "low"]
+
+    first.finished = True
+    index_scheduler.set_limits()
+    assert names(index_scheduler.get_running_jobs()) == ["high"]
+
+
+def test_max_workers_and_memory_are_shared(index_scheduler):
+    index_scheduler.set_limits(max_workers=2, max_memory_mb=1000, nice=5)
+    jobs = [FakeJob(name) for name in ("a", "b", "c")]
+    for job in jobs:
+        index_scheduler.submit(job)
+    assert names(index_scheduler.get_running_jobs()) == ["a", "b"]
+    assert jobs[0].limits == (5, 500)
+    assert not jobs[2].started
+
+
+def test_cancel_stops_running_and_drops_queued_jobs(index_scheduler):
+    running, queued = FakeJob("running"), FakeJob("queued")
+    index_scheduler.submit(running)
+    index_scheduler.submit(queued)
+    index_scheduler.cancel(queued)
+    index_scheduler.cancel(running)
+    assert running.stopped and not queued.stopped
+    running.finished = True
+    index_scheduler.set_limits()
+    assert index_scheduler.is_idle()
+    assert not queued.started
+
+
+def test_job_waits_for_the_cancelled_job_of_its_directory(index_scheduler):
+    index_scheduler.set_limits(max_workers=2)
+    cancelled = FakeJob("cancelled", "receipts")
+    index_scheduler.submit(cancelled)
+    index_scheduler.cancel(cancelled)
+    reindex = FakeJob("reindex", "receipts")
+    index_scheduler.submit(reindex)
+    other = FakeJob("other", "invoices")
+    index_scheduler.submit(other)
+    assert names(index_scheduler.get_running_jobs()) == ["cancelled", "other"]
+
+    # the cancelled job finishes its current page
+    cancelled.finished = True
+    index_scheduler.set_limits()
+    assert names(index_scheduler.get_running_jobs()) == ["other", "reindex"]
+
+
+def test_running_jobs_get_new_limits(index_scheduler):
+    index_scheduler.set_limits(max_workers=2, max_memory_mb=1000, nice=5)
+    job = FakeJob("running")
+    index_scheduler.submit(job)
+    index_scheduler.set_limits(max_memory_mb=600, nice=10)
+    assert job.limits == (10, 300)